@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+from typing import Optional
+
+import numpy as np
+
+
+def hash_audio(audio: np.ndarray) -> str:
+    """
+    Calculate the content hash of an audio buffer
+    :param audio: The audio samples
+    :return: The hex digest of the samples
+    """
+    return hashlib.sha256(np.ascontiguousarray(audio, dtype=np.float32).tobytes()).hexdigest()
+
+
+class ActivationCache:
+    """
+    Content-addressed on-disk cache for the Basic Pitch model output (note, onset and contour activations).
+    Every entry is stored as an .npz file named after the hash of the audio it was computed from.
+    The modification time of an entry is updated on every hit, so the least recently used entries can be evicted once
+    the total size of the cache exceeds max_size.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 2 * 1024 ** 3):
+        """
+        :param cache_dir: The directory the cache entries are stored in
+        :param max_size: The maximum size of all cache entries in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Load the model output stored for the given key
+        :param key: The hash of the audio the model output was computed from
+        :return: The model output or None, if the cache doesn't contain an entry for the key
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                model_output = {name: entry[name] for name in entry.files}
+            # Mark entry as recently used
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Missing entries and entries that were evicted or damaged while loading are treated as cache misses
+            return None
+        return model_output
+
+    def put(self, key: str, model_output: dict):
+        """
+        Store the model output for the given key and evict old entries if the cache grew too large
+        :param key: The hash of the audio the model output was computed from
+        :param model_output: The Basic Pitch model output
+        """
+        # Write to a temporary file first, so other processes never see partially written entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.savez(tmp_file, **model_output)
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits into max_size
+        """
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Entry has already been evicted by another process
+                pass
+            total_size -= size
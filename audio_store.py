@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+
+from file_index import INDEX_LOAD_ERRORS, atomic_write, files_unchanged, get_file_stats, list_song_files
+from transcription import load_vocals
+
+
+def list_vocals_files(songs_path: str) -> dict:
+    """
+    Find the vocals of all songs in a directory.
+    Every song is expected in its own subdirectory containing the separated vocals as vocals.wav.
+    :param songs_path: The songs directory
+    :return: The paths of the vocals files by song name
+    """
+    return list_song_files(songs_path, 'vocals.wav', only_existing=True)
+
+
+def get_store_paths(store_dir: str, sample_rate: int) -> tuple[str, str]:
+    # The store of every sample rate consists of the raw samples and the index
+    return os.path.join(store_dir, f'vocals_{sample_rate}.f32'), os.path.join(store_dir, f'vocals_{sample_rate}.npz')
+
+
+class AudioStore:
+    """
+    Decoded vocals of all songs in a directory at a single sample rate.
+    The samples of all songs are stored as one raw float32 file, which is memory-mapped read-only, and an .npz index
+    with the per-song offsets. Looking up a song returns a view into the mapped file, so no audio is decoded or copied,
+    and all processes mapping the same file share its pages through the page cache.
+    The index stores the modification time and size of every vocals file and is rebuilt if any of them changed.
+    """
+
+    def __init__(self, samples: np.ndarray, sample_rate: int, names: np.ndarray, offsets: np.ndarray,
+                 mtimes: np.ndarray, sizes: np.ndarray):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.names = names
+        self.offsets = offsets
+        self.mtimes = mtimes
+        self.sizes = sizes
+        self._positions = {name: i for i, name in enumerate(names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name: str):
+        return name in self._positions
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """
+        Get the decoded vocals of a song
+        :param name: The name of the song
+        :return: The mono float32 samples as read-only view into the mapped file
+        """
+        position = self._positions[name]
+        return self.samples[self.offsets[position]:self.offsets[position + 1]]
+
+    def is_up_to_date(self, vocals_files: dict) -> bool:
+        """
+        Check whether the store matches the given vocals files
+        :param vocals_files: The paths of the vocals files by song name
+        :return: True if the store contains exactly these songs and none of the files changed, otherwise False
+        """
+        return files_unchanged(vocals_files, self._positions, self.mtimes, self.sizes)
+
+    @classmethod
+    def load(cls, store_dir: str, sample_rate: int) -> 'AudioStore':
+        """
+        Map the store of a sample rate
+        :param store_dir: The directory of the stores
+        :param sample_rate: The sample rate of the store
+        :return: The audio store
+        :raises ValueError: If the samples file doesn't match the index, e.g. because building the store was interrupted
+        """
+        samples_path, index_path = get_store_paths(store_dir, sample_rate)
+        with np.load(index_path) as index:
+            names, offsets, mtimes, sizes = index['names'], index['offsets'], index['mtimes'], index['sizes']
+        if os.path.getsize(samples_path) != offsets[-1] * np.dtype(np.float32).itemsize:
+            raise ValueError(f'The samples of {index_path} are incomplete')
+        # Mapping an empty file is not supported
+        samples = np.memmap(samples_path, dtype=np.float32, mode='r') if offsets[-1] > 0 \
+            else np.zeros(0, dtype=np.float32)
+        return cls(samples, sample_rate, names, offsets, mtimes, sizes)
+
+    @classmethod
+    def build(cls, vocals_files: dict, store_dir: str, sample_rate: int) -> 'AudioStore':
+        """
+        Decode the given vocals files and write them to a store
+        :param vocals_files: The paths of the vocals files by song name
+        :param store_dir: The directory of the stores
+        :param sample_rate: The sample rate the vocals are decoded at, see transcription.working_sample_rate
+        :return: The audio store
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        samples_path, index_path = get_store_paths(store_dir, sample_rate)
+        names = sorted(vocals_files)
+        offsets = [0]
+        mtimes = []
+        sizes = []
+        # The songs are appended one after another, so only a single decoded song is kept in memory
+        with atomic_write(samples_path) as tmp_samples_path, atomic_write(index_path) as tmp_index_path:
+            with open(tmp_samples_path, 'wb') as samples_file:
+                for name in names:
+                    path = vocals_files[name]
+                    mtime, size = get_file_stats(path)
+                    audio = load_vocals(path, sample_rate).astype(np.float32, copy=False)
+                    samples_file.write(audio.tobytes())
+                    offsets.append(offsets[-1] + len(audio))
+                    mtimes.append(mtime)
+                    sizes.append(size)
+            np.savez(
+                tmp_index_path,
+                names=np.array(names, dtype=str),
+                offsets=np.array(offsets, dtype=np.int64),
+                mtimes=np.array(mtimes, dtype=np.int64),
+                sizes=np.array(sizes, dtype=np.int64),
+            )
+        return cls.load(store_dir, sample_rate)
+
+    @classmethod
+    def load_or_build(cls, songs_path: str, store_dir: str, sample_rate: int) -> 'AudioStore':
+        """
+        Load the audio store of a songs directory and rebuild it if it is missing or out of date
+        :param songs_path: The songs directory
+        :param store_dir: The directory of the stores
+        :param sample_rate: The sample rate of the store
+        :return: The up-to-date audio store
+        """
+        vocals_files = list_vocals_files(songs_path)
+        try:
+            store = cls.load(store_dir, sample_rate)
+            if store.is_up_to_date(vocals_files):
+                return store
+        except INDEX_LOAD_ERRORS:
+            # Missing, incomplete or corrupt stores are rebuilt
+            pass
+        print(f'Decoding vocals of {len(vocals_files)} songs in {songs_path} at {sample_rate} Hz')
+        return cls.build(vocals_files, store_dir, sample_rate)
+
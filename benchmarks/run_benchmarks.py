@@ -0,0 +1,437 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Directory the synthetic songs, the stage outputs and the caches are written to
+workspace_dir = 'data/benchmarks/'
+results_dir = 'results/benchmarks/'
+n_songs = 20
+song_seconds = 60.0
+# Number of times every stage is run, the throughput is taken from the median run
+repeats = 3
+# Number of worker processes of prepare_data and create_usdx_dataset
+workers = 2
+# Relative change of a metric that counts as regression when comparing with a baseline
+regression_threshold = 0.1
+stages = ['usdx_to_midi', 'prepare_data', 'create_usdx_dataset', 'transcribe_vocals', 'evaluate', 'f_measure',
+          'optimizer_step']
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Prefix of the line a stage process reports its result with
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+# Metrics compared with a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'songs_per_second': True,
+    'notes_per_second': True,
+    'mb_per_second': True,
+    'latency_p50': False,
+    'latency_p90': False,
+    'peak_rss_mb': False,
+}
+
+
+def load_songs() -> list[dict]:
+    with open('songs.json') as metadata_file:
+        return json.load(metadata_file)['songs']
+
+
+def get_usdx_path(song: dict, extension: str) -> str:
+    return os.path.join('data', 'usdx', song['name'], f'{song["name"]}{extension}')
+
+
+def get_vocals_path(song: dict) -> str:
+    return os.path.join(os.getcwd(), 'data', 'test', song['name'], 'vocals.wav')
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def bench_usdx_to_midi(songs: list, config: dict):
+    from usdx_dataset.usdx_tools import usdx_to_midi
+
+    def run():
+        latencies = []
+        for song in songs:
+            out_path = os.path.join('out', 'midi', f'{song["name"]}.mid')
+            _, seconds = timed(usdx_to_midi, get_usdx_path(song, '.txt'), out_path)
+            latencies.append(seconds)
+        return {'latencies': latencies, 'songs': len(songs), 'notes': sum(song['notes'] for song in songs),
+                'bytes': sum(os.path.getsize(get_usdx_path(song, '.txt')) for song in songs)}
+
+    return None, run
+
+
+def bench_prepare_data(songs: list, config: dict):
+    from usdx_dataset import prepare_data
+
+    prepare_data.workers = config['workers']
+
+    def run():
+        # Remove the outputs and the manifest, so every song is prepared again
+        shutil.rmtree('data/prepared', ignore_errors=True)
+        _, seconds = timed(prepare_data.prepare_data, 'data/usdx/')
+        return {'latencies': [seconds], 'songs': len(songs), 'notes': sum(song['notes'] for song in songs),
+                'bytes': sum(os.path.getsize(get_usdx_path(song, '.mp3')) for song in songs)}
+
+    return None, run
+
+
+def bench_create_usdx_dataset(songs: list, config: dict):
+    from usdx_dataset import create_usdx_dataset, prepare_data
+
+    prepare_data.workers = config['workers']
+    create_usdx_dataset.workers = config['workers']
+
+    def setup():
+        # Only prepares the songs that were not prepared yet, e.g. by the prepare_data stage
+        prepare_data.prepare_data('data/usdx/')
+
+    def run():
+        _, seconds = timed(create_usdx_dataset.generate_datasets)
+        prepared = [f.path for f in os.scandir(create_usdx_dataset.input_dir) if f.is_dir()]
+        return {'latencies': [seconds], 'songs': len(prepared), 'notes': sum(song['notes'] for song in songs),
+                'bytes': sum(f.stat().st_size for song in prepared for f in os.scandir(song))}
+
+    return setup, run
+
+
+def bench_transcribe_vocals(songs: list, config: dict):
+    from models import models
+    from transcription import transcribe_vocals
+
+    def run():
+        latencies = []
+        notes = 0
+        for song in songs:
+            est_notes, seconds = timed(transcribe_vocals, get_vocals_path(song))
+            latencies.append(seconds)
+            notes += len(est_notes)
+        return {'latencies': latencies, 'songs': len(songs), 'notes': notes,
+                'bytes': sum(os.path.getsize(get_vocals_path(song)) for song in songs)}
+
+    return lambda: models.preload('basic_pitch'), run
+
+
+def perturb_notes(reference, rng: np.random.Generator):
+    # Estimates close to the references, with timing and pitch errors as well as dropped notes
+    from evaluate_midi import EvalData
+
+    keep = rng.random(len(reference)) > 0.1
+    onsets = np.maximum(reference.intervals[keep, 0] + rng.normal(0, 0.03, keep.sum()), 0)
+    offsets = np.maximum(reference.intervals[keep, 1] + rng.normal(0, 0.1, keep.sum()), onsets + 0.01)
+    pitches = reference.pitches[keep] + rng.choice([0, 0, 0, 1, -1, 12], keep.sum())
+    return EvalData.from_arrays(pitches, onsets, offsets)
+
+
+def bench_evaluation(songs: list, metric):
+    from reference_index import ReferenceIndex
+
+    state = {}
+
+    def setup():
+        references = ReferenceIndex.load_or_build(os.path.join(os.getcwd(), 'data', 'test'), 'cache/references.npz')
+        rng = np.random.default_rng(0)
+        state['pairs'] = [(references[song['name']], perturb_notes(references[song['name']], rng)) for song in songs]
+
+    def run():
+        latencies = [timed(metric, reference, estimate)[1] for reference, estimate in state['pairs']]
+        return {'latencies': latencies, 'songs': len(songs),
+                'notes': sum(len(reference) for reference, _ in state['pairs']), 'bytes': 0}
+
+    return setup, run
+
+
+def bench_evaluate(songs: list, config: dict):
+    from evaluate_midi import evaluate
+    return bench_evaluation(songs, evaluate)
+
+
+def bench_f_measure(songs: list, config: dict):
+    from evaluate_midi import f_measure
+    return bench_evaluation(songs, f_measure)
+
+
+def bench_optimizer_step(songs: list, config: dict):
+    import optimize_transcription as ot
+    from audio_store import AudioStore
+    from reference_index import ReferenceIndex
+    from skopt import Optimizer
+    from skopt.utils import cook_estimator, normalize_dimensions
+
+    songs_path = os.path.join(os.getcwd(), 'data', 'test')
+    ot.songs_path = songs_path
+    ot.reference_index_path = 'cache/references.npz'
+    ot.activation_cache_dir = 'cache/activations'
+    ot.audio_store_dir = 'cache/audio'
+    ot.songs_per_inference_batch = config['inference_batch_songs']
+    batch = [{'name': song['name'], 'vocals': get_vocals_path(song)} for song in songs[:ot.batch_size]]
+    space = normalize_dimensions(ot.param_ranges)
+    rng = np.random.default_rng(0)
+    # Earlier trials, so the optimizer fits its model like in the middle of a run
+    history_x = space.rvs(n_samples=ot.n_initial_points, random_state=0)
+    history_y = rng.uniform(0.3, 0.9, ot.n_initial_points).tolist()
+    ml_model_index = [dimension.name for dimension in ot.param_ranges].index('ml_model')
+
+    def setup():
+        ReferenceIndex.load_or_build(songs_path, ot.reference_index_path)
+        for sample_rate in sorted(ot.get_sample_rates()):
+            AudioStore.load_or_build(songs_path, ot.audio_store_dir, sample_rate)
+        ot.init_worker()
+
+    def run():
+        # A cold activation cache, like for a candidate that was not evaluated before
+        shutil.rmtree(ot.activation_cache_dir, ignore_errors=True)
+        os.makedirs(ot.activation_cache_dir, exist_ok=True)
+        start_time = time.perf_counter()
+        optimizer = Optimizer(space, cook_estimator('GP', space=space, random_state=0, noise='gaussian'),
+                              n_initial_points=0, acq_optimizer='lbfgs', random_state=0)
+        optimizer.tell(history_x, history_y)
+        params = optimizer.ask()
+        # The enhancement model of the candidate is replaced, so the step never depends on models that are not cached
+        params[ml_model_index] = config['ml_model']
+        # evaluate_transcription_batch collects the profile of every batch itself
+        scores, latencies, profiles = zip(*ot.evaluate_songs([(song, params) for song in batch]))
+        profiles = [profile for profile in profiles if profile is not None]
+        optimizer.tell(params, sum(scores) / len(scores))
+        return {'latencies': list(latencies), 'songs': len(batch),
+                'notes': sum(profile['counters'].get('notes_emitted', 0) for profile in profiles),
+                'bytes': sum(os.path.getsize(song['vocals']) for song in batch),
+                'step_seconds': time.perf_counter() - start_time, 'profiles': profiles}
+
+    return setup, run
+
+
+def run_stage(name: str, config: dict) -> dict:
+    """
+    Run a single stage in the current process, which is started for this stage only, so the peak memory is its own
+    :param name: The name of the stage
+    :param config: The benchmark configuration
+    :return: The measurements of the stage
+    """
+    from instrumentation import collect, configure, get_peak_rss, merge_profiles
+
+    songs = load_songs()
+    setup, run = globals()[f'bench_{name}'](songs, config)
+    setup_seconds = timed(setup)[1] if setup is not None else 0.0
+    # Includes the finished worker processes of the stage, e.g. of prepare_data
+    setup_rss_mb = get_peak_rss(children=True) / 1024 ** 2
+    # The time spent in the stages of the pipeline is recorded as well, e.g. decoding and inference of transcribe_vocals
+    configure(enabled=True)
+    collect()
+    runs = []
+    profiles = []
+    for _ in range(config['repeats']):
+        measurement, seconds = timed(run)
+        profiles += measurement.pop('profiles', [])
+        runs.append({'seconds': seconds, **measurement})
+    profile = merge_profiles(profiles + [collect()])
+    peak_rss_mb = get_peak_rss(children=True) / 1024 ** 2
+    return {'setup_seconds': setup_seconds, 'setup_rss_mb': setup_rss_mb, 'peak_rss_mb': peak_rss_mb,
+            'runs': runs, 'substages': {stage_name: stats['seconds'] / config['repeats']
+                                        for stage_name, stats in profile['stages'].items()}}
+
+
+def summarize_stage(result: dict) -> dict:
+    """
+    Calculate the throughput and latency of a stage from its runs
+    :param result: The measurements returned by run_stage
+    :return: The summary of the stage
+    """
+    runs = result['runs']
+    run = sorted(runs, key=lambda run: run['seconds'])[len(runs) // 2]
+    latencies = np.array([latency for run in runs for latency in run['latencies']])
+    summary = {
+        'songs': run['songs'],
+        'notes': run['notes'],
+        'seconds': run['seconds'],
+        'songs_per_second': run['songs'] / run['seconds'],
+        'notes_per_second': run['notes'] / run['seconds'],
+        'mb_per_second': run['bytes'] / 1024 ** 2 / run['seconds'] if run['bytes'] else None,
+        # Latency of a single song, or of the whole run for stages processing all songs at once
+        'latency_unit': 'song' if len(run['latencies']) == run['songs'] else 'run',
+        **{f'latency_p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+        'latency_max': float(latencies.max()),
+        'setup_seconds': result['setup_seconds'],
+        'setup_rss_mb': result['setup_rss_mb'],
+        'peak_rss_mb': result['peak_rss_mb'],
+        'substages': result['substages'],
+    }
+    if 'step_seconds' in run:
+        summary['step_seconds'] = float(np.median([run['step_seconds'] for run in runs]))
+    return summary
+
+
+def run_stage_process(name: str, config: dict, workspace: str) -> dict:
+    """
+    Run a stage in its own process and wait for its result
+    :return: The summary of the stage, or the error if the stage failed
+    """
+    env = dict(os.environ)
+    # The stage runs in the workspace, but imports the modules of the repository
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    # CPU only, and the models are only read from the local caches
+    env['CUDA_VISIBLE_DEVICES'] = '-1'
+    env['HF_HUB_OFFLINE'] = '1'
+    env['TRANSFORMERS_OFFLINE'] = '1'
+    env['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    command = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--run-stage', name, '--config', json.dumps(config)]
+    process = subprocess.run(command, cwd=workspace, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             text=True)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return summarize_stage(json.loads(line[len(RESULT_PREFIX):]))
+    output = process.stdout.strip().splitlines()
+    return {'error': output[-1] if output else f'Exit code {process.returncode}', 'output': output[-20:]}
+
+
+def get_commit() -> tuple[str | None, bool]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(status.strip())
+
+
+def run_benchmarks(config: dict, workspace: str, selected_stages: list) -> dict:
+    """
+    Generate the synthetic songs and run the selected stages on them
+    :param config: The benchmark configuration
+    :param workspace: The directory the songs and all outputs are written to
+    :param selected_stages: The names of the stages to run
+    :return: The results of all stages and the environment they were measured in
+    """
+    from benchmarks.synthetic_songs import generate_library
+
+    os.makedirs(workspace, exist_ok=True)
+    print(f'Generating {config["songs"]} songs of {config["seconds"]:.0f}s in {workspace}')
+    songs = generate_library(workspace, config['songs'], config['seconds'], config['seed'])
+    # The enhancement models are loaded from the models directory relative to the working directory
+    models_link = os.path.join(workspace, 'models')
+    if os.path.isdir(os.path.join(REPO_DIR, 'models')) and not os.path.lexists(models_link):
+        os.symlink(os.path.join(REPO_DIR, 'models'), models_link)
+
+    commit, dirty = get_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'config': {**config, 'total_notes': sum(song['notes'] for song in songs)},
+        'stages': {},
+    }
+    for name in selected_stages:
+        print(f'Running {name}')
+        result = run_stage_process(name, config, workspace)
+        results['stages'][name] = result
+        if 'error' in result:
+            print(f'{name} failed: {result["error"]}')
+        else:
+            print(f'{name}: {result["songs_per_second"]:.2f} songs/s, {result["notes_per_second"]:.0f} notes/s, '
+                  f'p50 {result["latency_p50"] * 1000:.1f} ms, peak RSS {result["peak_rss_mb"]:.0f} MB')
+    return results
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> tuple[str, list]:
+    """
+    Compare the results of two benchmark runs
+    :param baseline: The results of the earlier run
+    :param current: The results of the later run
+    :param threshold: The relative change of a metric that counts as regression
+    :return: The comparison as text table and the regressions as (stage, metric, relative change)
+    """
+    lines = []
+    if baseline['config'] != current['config']:
+        lines.append(f'Warning: the configurations differ: {baseline["config"]} != {current["config"]}')
+    lines.append(f'{"stage":<22}{"metric":<20}{"baseline":>12}{"current":>12}{"change":>10}')
+    regressions = []
+    for name, result in current['stages'].items():
+        baseline_result = baseline['stages'].get(name)
+        if baseline_result is None or 'error' in baseline_result or 'error' in result:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = baseline_result.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = (change < -threshold) if higher_is_better else (change > threshold)
+            if regressed:
+                regressions.append((name, metric, change))
+            lines.append(f'{name:<22}{metric:<20}{before:>12.4g}{after:>12.4g}{change:>+10.1%}'
+                         f'{" !" if regressed else ""}')
+    lines.append(f'{len(regressions)} regressions of more than {threshold:.0%}')
+    return '\n'.join(lines), regressions
+
+
+def load_results(path: str) -> dict:
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic USDX songs')
+    parser.add_argument('--songs', type=int, default=n_songs)
+    parser.add_argument('--seconds', type=float, default=song_seconds, help='Length of every song')
+    parser.add_argument('--repeats', type=int, default=repeats)
+    parser.add_argument('--workers', type=int, default=workers)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ml-model', choices=['metricgan', 'mtl'], default=None,
+                        help='Enhancement model of the optimizer step, needs a cached model')
+    parser.add_argument('--inference-batch-songs', type=int, default=8,
+                        help='Songs of the optimizer step transcribed together, 1 runs the inference song by song')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages)
+    parser.add_argument('--workspace', default=workspace_dir)
+    parser.add_argument('--output', help=f'Results file, {results_dir}<commit>.json by default')
+    parser.add_argument('--baseline', help='Results file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=regression_threshold)
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two results files without running the benchmarks')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        result = run_stage(args.run_stage, json.loads(args.config))
+        print(RESULT_PREFIX + json.dumps(result))
+        return 0
+    if args.compare:
+        report, regressions = compare_results(load_results(args.compare[0]), load_results(args.compare[1]),
+                                              args.threshold)
+        print(report)
+        return 1 if regressions else 0
+
+    config = {'songs': args.songs, 'seconds': args.seconds, 'repeats': args.repeats, 'workers': args.workers,
+              'seed': args.seed, 'ml_model': args.ml_model, 'inference_batch_songs': args.inference_batch_songs}
+    results = run_benchmarks(config, os.path.abspath(args.workspace), args.stages)
+    output = args.output or os.path.join(results_dir, f'{(results["commit"] or "unknown")[:10]}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f'Results written to {output}')
+
+    failed = [name for name, result in results['stages'].items() if 'error' in result]
+    if args.baseline:
+        report, regressions = compare_results(load_results(args.baseline), results, args.threshold)
+        print(report)
+        if regressions:
+            return 1
+    return 2 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
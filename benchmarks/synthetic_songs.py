@@ -0,0 +1,179 @@
+import json
+import os
+
+import numpy as np
+import soundfile
+
+from usdx_dataset.usdx_tools import usdx_to_midi
+
+# Sample rate of the rendered audio, the sample rate of the songs and of the separated vocals
+SAMPLE_RATE = 44100
+# Level of the white noise and of the accompaniment bleeding into the separated vocals, relative to the voice
+NOISE_LEVEL = 10 ** (-35 / 20)
+BLEED_LEVEL = 10 ** (-20 / 20)
+# Level of the accompaniment in the full song
+ACCOMPANIMENT_LEVEL = 10 ** (-6 / 20)
+
+
+def generate_notes(rng: np.random.Generator, seconds: float, bpm: float, gap_ms: float) -> list[dict]:
+    """
+    Generate the notes of a melody, sung in phrases with rests between them
+    :param rng: The random generator
+    :param seconds: The length of the song
+    :param bpm: The BPM of the song as written in the USDX file, a beat lasts a quarter of 60 / bpm seconds
+    :param gap_ms: The start of the first note in milliseconds
+    :return: The notes with their start beat, length in beats, USDX pitch and type, and the line breaks
+    """
+    beat_seconds = 60 / (bpm * 4)
+    end_beat = int((seconds - gap_ms / 1000) / beat_seconds)
+    notes = []
+    beat = 0
+    pitch = int(rng.integers(-3, 8))
+    while True:
+        for _ in range(rng.integers(4, 11)):
+            length = int(rng.integers(2, 13))
+            if beat + length >= end_beat:
+                return notes
+            note_type = '*' if rng.random() < 0.1 else ':'
+            notes.append({'type': note_type, 'start': beat, 'length': length, 'pitch': pitch})
+            beat += length + int(rng.integers(0, 3))
+            # Melodies mostly move in small steps within about an octave
+            pitch = int(np.clip(pitch + rng.choice([-4, -2, -1, 0, 1, 2, 3, 5]), -5, 12))
+        beat += int(rng.integers(8, 25))
+        notes.append({'type': '-', 'start': beat - 2})
+
+
+def write_usdx_file(path: str, name: str, bpm: float, gap_ms: float, notes: list[dict]):
+    lines = [
+        f'#TITLE:{name}',
+        '#ARTIST:Synthetic',
+        f'#MP3:{name}.mp3',
+        # USDX files often use a decimal comma
+        f'#BPM:{bpm:.2f}'.replace('.', ','),
+        f'#GAP:{gap_ms:.0f}',
+    ]
+    for note in notes:
+        if note['type'] == '-':
+            lines.append(f'- {note["start"]}')
+        else:
+            lines.append(f'{note["type"]} {note["start"]} {note["length"]} {note["pitch"]} la')
+    lines.append('E')
+    with open(path, 'w', encoding='utf-8') as usdx_file:
+        usdx_file.write('\n'.join(lines) + '\n')
+
+
+def render_tone(frequencies: np.ndarray, rng: np.random.Generator, harmonics: int) -> np.ndarray:
+    # Harmonic tone with decaying overtones, following the given instantaneous fundamental frequency
+    phase = 2 * np.pi * np.cumsum(frequencies) / SAMPLE_RATE + rng.uniform(0, 2 * np.pi)
+    tone = np.zeros(len(frequencies))
+    for harmonic in range(1, harmonics + 1):
+        # Overtones above the Nyquist frequency would alias
+        audible = frequencies * harmonic < SAMPLE_RATE / 2
+        tone += audible * np.sin(harmonic * phase) / harmonic
+    return tone
+
+
+def render_envelope(length: int, attack: int, release: int) -> np.ndarray:
+    envelope = np.ones(length)
+    attack, release = min(attack, length // 2), min(release, length // 2)
+    envelope[:attack] = np.linspace(0, 1, attack, endpoint=False)
+    if release:
+        envelope[-release:] = np.linspace(1, 0, release)
+    return envelope
+
+
+def render_song(rng: np.random.Generator, seconds: float, bpm: float, gap_ms: float,
+                notes: list[dict]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Render the sung melody and an accompaniment of sustained chords
+    :return: The voice and the accompaniment as mono float64 samples
+    """
+    length = int(seconds * SAMPLE_RATE)
+    beat_seconds = 60 / (bpm * 4)
+    voice = np.zeros(length)
+    for note in notes:
+        if note['type'] == '-':
+            continue
+        start = int((gap_ms / 1000 + note['start'] * beat_seconds) * SAMPLE_RATE)
+        end = min(int((gap_ms / 1000 + (note['start'] + note['length']) * beat_seconds) * SAMPLE_RATE), length)
+        if end <= start:
+            continue
+        t = np.arange(end - start) / SAMPLE_RATE
+        # Vibrato of about a third of a semitone, fading in after the onset
+        vibrato = 0.3 * np.sin(2 * np.pi * rng.uniform(4.5, 6.5) * t) * np.minimum(t / 0.3, 1)
+        frequencies = 440 * 2 ** ((60 + note['pitch'] + vibrato - 69) / 12)
+        envelope = render_envelope(end - start, int(0.02 * SAMPLE_RATE), int(0.05 * SAMPLE_RATE))
+        voice[start:end] += rng.uniform(0.5, 0.9) * envelope * render_tone(frequencies, rng, 6)
+
+    accompaniment = np.zeros(length)
+    chord_length = int(16 * beat_seconds * SAMPLE_RATE)
+    for start in range(0, length, chord_length):
+        end = min(start + chord_length, length)
+        root = 48 + int(rng.choice([0, 5, 7, 9]))
+        for interval in (0, 4, 7):
+            frequencies = np.full(end - start, 440 * 2 ** ((root + interval - 69) / 12))
+            envelope = render_envelope(end - start, int(0.01 * SAMPLE_RATE), int(0.2 * SAMPLE_RATE))
+            accompaniment[start:end] += 0.2 * envelope * render_tone(frequencies, rng, 4)
+    return voice, accompaniment
+
+
+def normalize(samples: np.ndarray) -> np.ndarray:
+    # Leave some headroom, so the 16 bit files don't clip
+    peak = np.max(np.abs(samples))
+    return (samples * (0.9 / peak) if peak > 0 else samples).astype(np.float32)
+
+
+def generate_song(workspace: str, name: str, seconds: float, rng: np.random.Generator) -> dict:
+    """
+    Generate a synthetic song in the layouts the pipeline stages read:
+    data/usdx/<name>/ contains the USDX file and the full song as MP3, like the USDX song library, and
+    data/test/<name>/ contains the separated vocals and the reference MIDI file, like the test songs of the optimizer.
+    The separated vocals contain noise and some of the accompaniment, like the output of a real separation.
+    :param workspace: The directory the data directories are created in
+    :param name: The name of the song
+    :param seconds: The length of the song
+    :param rng: The random generator
+    :return: The metadata of the song
+    """
+    bpm = float(rng.uniform(200, 400))
+    gap_ms = float(rng.uniform(500, 3000))
+    notes = generate_notes(rng, seconds, bpm, gap_ms)
+    voice, accompaniment = render_song(rng, seconds, bpm, gap_ms, notes)
+
+    usdx_dir = os.path.join(workspace, 'data', 'usdx', name)
+    test_dir = os.path.join(workspace, 'data', 'test', name)
+    os.makedirs(usdx_dir, exist_ok=True)
+    os.makedirs(test_dir, exist_ok=True)
+    usdx_path = os.path.join(usdx_dir, f'{name}.txt')
+    write_usdx_file(usdx_path, name, bpm, gap_ms, notes)
+    soundfile.write(os.path.join(usdx_dir, f'{name}.mp3'), normalize(voice + ACCOMPANIMENT_LEVEL * accompaniment),
+                    SAMPLE_RATE, format='MP3', subtype='MPEG_LAYER_III')
+    noise = rng.standard_normal(len(voice)) * NOISE_LEVEL * np.max(np.abs(voice))
+    soundfile.write(os.path.join(test_dir, 'vocals.wav'), normalize(voice + BLEED_LEVEL * accompaniment + noise),
+                    SAMPLE_RATE, subtype='PCM_16')
+    usdx_to_midi(usdx_path, os.path.join(test_dir, f'{name}.mid'))
+    return {'name': name, 'seconds': seconds, 'notes': sum(note['type'] != '-' for note in notes)}
+
+
+def generate_library(workspace: str, n_songs: int, seconds: float, seed: int = 0) -> list[dict]:
+    """
+    Generate synthetic songs and store their metadata in songs.json, reusing songs generated with the same settings
+    :param workspace: The directory the songs are generated in
+    :param n_songs: The number of songs
+    :param seconds: The length of every song
+    :param seed: The seed of the random generator, the same seed always generates the same songs
+    :return: The metadata of the songs
+    """
+    settings = {'songs': n_songs, 'seconds': seconds, 'seed': seed}
+    metadata_path = os.path.join(workspace, 'songs.json')
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata['settings'] == settings:
+            return metadata['songs']
+
+    rng = np.random.default_rng(seed)
+    songs = [generate_song(workspace, f'song_{i:04d}', seconds, rng) for i in range(n_songs)]
+    with open(metadata_path, 'w') as metadata_file:
+        json.dump({'settings': settings, 'songs': songs}, metadata_file, indent=2)
+    return songs
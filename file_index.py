@@ -0,0 +1,75 @@
+import os
+import zipfile
+from contextlib import contextmanager
+
+# Errors of loading a missing, truncated or otherwise corrupt index, e.g. after a crash or a full disk. Indexes
+# raising one of them are rebuilt.
+INDEX_LOAD_ERRORS = (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile)
+
+
+def list_song_files(songs_path: str, file_name: str, only_existing: bool = False) -> dict:
+    """
+    Find a file of every song in a directory.
+    Every song is expected in its own subdirectory.
+    :param songs_path: The songs directory
+    :param file_name: The name of the file in the song directory, {name} is replaced by the name of the song
+    :param only_existing: Skip songs without the file instead of returning a path that doesn't exist
+    :return: The paths of the files by song name
+    """
+    song_files = {song.name: os.path.join(song.path, file_name.format(name=song.name))
+                  for song in os.scandir(songs_path) if song.is_dir()}
+    if only_existing:
+        return {name: path for name, path in song_files.items() if os.path.exists(path)}
+    return song_files
+
+
+def get_file_stats(path: str) -> tuple[int, int]:
+    """
+    Get the modification time and size an index stores for a file.
+    Call it before reading the file, so a file changing in the meantime invalidates the index on the next run.
+    :param path: The path of the file
+    :return: The modification time in nanoseconds and the size in bytes
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def files_unchanged(files: dict, positions: dict, mtimes, sizes) -> bool:
+    """
+    Check whether an index matches the given files
+    :param files: The paths of the files by song name
+    :param positions: The positions of the songs in the index by song name
+    :param mtimes: The modification times stored in the index
+    :param sizes: The sizes stored in the index
+    :return: True if the index contains exactly these songs and none of the files changed, otherwise False
+    """
+    if set(files) != set(positions):
+        return False
+    for name, path in files.items():
+        position = positions[name]
+        try:
+            mtime, size = get_file_stats(path)
+        except FileNotFoundError:
+            return False
+        if mtime != mtimes[position] or size != sizes[position]:
+            return False
+    return True
+
+
+@contextmanager
+def atomic_write(path: str):
+    """
+    Write a file through a temporary file, which replaces the file only if writing it succeeded.
+    A crash therefore never leaves a partially written file behind.
+    :param path: The path of the file
+    :return: The path of the temporary file, which keeps the extension of the file, e.g. for np.savez
+    """
+    root, extension = os.path.splitext(path)
+    tmp_path = f'{root}.tmp{extension}'
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
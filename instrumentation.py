@@ -0,0 +1,218 @@
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# Instrumentation is switched on with TRANSCRIPTION_PROFILE=1. TRANSCRIPTION_PROFILE=memory additionally traces the
+# allocations of Python and numpy with tracemalloc, which slows down the stages noticeably.
+PROFILE_ENV = 'TRANSCRIPTION_PROFILE'
+
+_settings = {
+    'enabled': os.environ.get(PROFILE_ENV, '0') not in ('', '0'),
+    'trace_memory': os.environ.get(PROFILE_ENV) == 'memory',
+}
+# Statistics collected since the last call of collect, per process
+_stages = {}
+_counters = {}
+# Highest traced memory of the stages that are currently measured, outermost first
+_traced_peaks = []
+_disabled = nullcontext()
+
+
+def configure(enabled: bool = None, trace_memory: bool = None):
+    """
+    Switch the instrumentation on or off, overriding TRANSCRIPTION_PROFILE.
+    Worker processes inherit the environment, so set TRANSCRIPTION_PROFILE instead when profiling a worker pool.
+    :param enabled: Whether the stages and counters should be recorded. Unchanged if None.
+    :param trace_memory: Whether the allocations should be traced with tracemalloc. Unchanged if None.
+    """
+    if enabled is not None:
+        _settings['enabled'] = enabled
+    if trace_memory is not None:
+        _settings['trace_memory'] = trace_memory
+    if not (_settings['enabled'] and _settings['trace_memory']) and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled() -> bool:
+    return _settings['enabled']
+
+
+def get_peak_rss(children: bool = False) -> int:
+    """
+    Get the highest resident set size of the process so far
+    :param children: Also include the finished child processes, e.g. the workers of a pool
+    :return: The peak RSS in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def _measure(name: str):
+    trace_memory = _settings['trace_memory']
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # Nested stages reset the peak, so the peak so far is passed on to the enclosing stages first
+        current, peak = tracemalloc.get_traced_memory()
+        _traced_peaks[:] = [max(traced_peak, peak) for traced_peak in _traced_peaks]
+        tracemalloc.reset_peak()
+        _traced_peaks.append(current)
+    rss_before = get_peak_rss()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = record(name, time.perf_counter() - start_time)
+        # Only grows if the stage raised the peak memory of the process, which is what limits the number of workers
+        stats['rss_growth'] = max(stats['rss_growth'], get_peak_rss() - rss_before)
+        if trace_memory and _traced_peaks:
+            _, peak = tracemalloc.get_traced_memory()
+            _traced_peaks[:] = [max(traced_peak, peak) for traced_peak in _traced_peaks]
+            stats['traced_peak'] = max(stats.get('traced_peak', 0), _traced_peaks.pop() - current)
+
+
+def record(name: str, seconds: float) -> dict | None:
+    """
+    Add the time of a stage that was measured separately, e.g. the time between two calls of a callback
+    :param name: The name of the stage
+    :param seconds: The time spent in the stage
+    :return: The statistics of the stage, or None if the instrumentation is disabled
+    """
+    if not _settings['enabled']:
+        return None
+    stats = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rss_growth': 0})
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    return stats
+
+
+def stage(name: str):
+    """
+    Measure a stage of the pipeline: its wall time, the growth of the peak RSS and, if enabled, the peak of the
+    traced allocations above the allocations at the start of the stage. Stages can be nested and called several
+    times, their statistics are summed up until they are collected.
+    Does nothing if the instrumentation is disabled.
+    :param name: The name of the stage
+    :return: A context manager measuring the code it encloses
+    """
+    if not _settings['enabled']:
+        return _disabled
+    return _measure(name)
+
+
+def count(name: str, value: int = 1):
+    """
+    Increase a counter, e.g. the number of frames processed or notes emitted
+    :param name: The name of the counter
+    :param value: The amount to add
+    """
+    if _settings['enabled']:
+        _counters[name] = _counters.get(name, 0) + int(value)
+
+
+def collect() -> dict | None:
+    """
+    Get the statistics recorded since the last call and reset them
+    :return: The statistics of the stages and the counters, or None if the instrumentation is disabled
+    """
+    if not _settings['enabled']:
+        return None
+    profile = {'stages': dict(_stages), 'counters': dict(_counters), 'peak_rss': get_peak_rss()}
+    _stages.clear()
+    _counters.clear()
+    return profile
+
+
+def merge_profiles(profiles: list) -> dict:
+    """
+    Sum up the statistics of several profiles, e.g. of all songs of a trial
+    :param profiles: The profiles returned by collect. Profiles that are None are skipped.
+    :return: The merged profile
+    """
+    merged = {'stages': {}, 'counters': {}, 'peak_rss': 0}
+    for profile in profiles:
+        if profile is None:
+            continue
+        for name, stats in profile['stages'].items():
+            merged_stats = merged['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'rss_growth': 0})
+            merged_stats['calls'] += stats['calls']
+            merged_stats['seconds'] += stats['seconds']
+            for key in ('rss_growth', 'traced_peak'):
+                if key in stats:
+                    merged_stats[key] = max(merged_stats.get(key, 0), stats[key])
+        for name, value in profile['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        merged['peak_rss'] = max(merged['peak_rss'], profile['peak_rss'])
+    return merged
+
+
+def append_profile(path: str, row: dict):
+    """
+    Append a profile to a JSON lines file
+    :param path: The path of the file
+    :param row: The profile and the data identifying it, e.g. the run and the trial
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as file:
+        file.write(json.dumps(row) + '\n')
+
+
+def load_profiles(path: str, runs: list = None) -> list:
+    # Only imported when reading profiles, since the trial store imports scikit-optimize
+    from trial_store import read_rows
+
+    return read_rows(path, runs)
+
+
+def summarize(rows: list) -> str:
+    """
+    Create a report of the time and memory spent in every stage over many trials
+    :param rows: The rows of a profile file, each containing the profiles of the songs of a trial and the profile of
+    the main process
+    :return: The report as text table
+    """
+    if not rows:
+        return 'No profiles'
+    profiles = [profile for row in rows for profile in row['songs'] + [row.get('main')] if profile is not None]
+    # Distribution of the time of a stage per song (or per trial for the stages of the main process)
+    seconds = {}
+    for profile in profiles:
+        for name, stats in profile['stages'].items():
+            seconds.setdefault(name, []).append(stats['seconds'])
+    merged = merge_profiles(profiles)
+    total = sum(row['seconds'] for row in rows)
+    n_songs = sum(len(row['songs']) for row in rows)
+
+    lines = [
+        f'{len(rows)} trials, {n_songs} songs in {total:.1f}s ({n_songs / total:.2f} songs/s)',
+        f'{"stage":<20}{"calls":>8}{"total s":>10}{"mean s":>9}{"p50 s":>9}{"p95 s":>9}'
+        f'{"RSS growth":>14}{"traced peak":>14}',
+    ]
+    for name, stats in sorted(merged['stages'].items(), key=lambda item: -item[1]['seconds']):
+        traced_peak = f'{stats["traced_peak"] / 1024 ** 2:.1f} MiB' if 'traced_peak' in stats else '-'
+        lines.append(
+            f'{name:<20}{stats["calls"]:>8}{stats["seconds"]:>10.1f}{stats["seconds"] / stats["calls"]:>9.3f}'
+            f'{np.percentile(seconds[name], 50):>9.3f}{np.percentile(seconds[name], 95):>9.3f}'
+            f'{stats["rss_growth"] / 1024 ** 2:>10.1f} MiB{traced_peak:>14}'
+        )
+    lines.append(f'Peak RSS: {merged["peak_rss"] / 1024 ** 2:.1f} MiB')
+    for name, value in sorted(merged['counters'].items()):
+        lines.append(f'{name}: {value} ({value / total:.1f}/s)')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python instrumentation.py <profile file> [<run>...]')
+        sys.exit(1)
+    print(summarize(load_profiles(sys.argv[1], sys.argv[2:] or None)))
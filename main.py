@@ -1,11 +1,34 @@
+import os
 from typing import Optional
 
-import demucs.separate
 from basic_pitch.inference import predict_and_save, predict
+from basic_pitch.note_creation import note_events_to_midi
 
+from separation import save_audio, separate_files, set_threads
+from streaming import read_blocks, stream_notes
+from transcription import extract_notes, load_vocals, run_inference_batch
 
-def split(in_path: str, out_path: str):
-    demucs.separate.main(["--two-stems", "vocals", "-n", "htdemucs_ft", "-o", out_path, in_path])
+
+def split(in_path: str, out_path: str, threads: int = None, segment: float = None):
+    """
+    Split a track into vocals.wav and no_vocals.wav, stored in <out_path>/htdemucs_ft/<track name>/ like the Demucs CLI
+    :param in_path: The path of the audio file
+    :param out_path: The output directory
+    :param threads: The number of torch threads. If None, the torch default is used.
+    :param segment: The length of the segments the model processes at once, in seconds
+    """
+    split_all([in_path], out_path, threads, segment)
+
+
+def split_all(in_paths: list[str], out_path: str, threads: int = None, segment: float = None):
+    """
+    Split several tracks like split, loading the separation model only once
+    """
+    set_threads(threads)
+    for path, (vocals, accompaniment) in separate_files(in_paths, segment=segment, return_accompaniment=True):
+        track_dir = os.path.join(out_path, 'htdemucs_ft', os.path.basename(path).rsplit('.', 1)[0])
+        save_audio(vocals, os.path.join(track_dir, 'vocals.wav'))
+        save_audio(accompaniment, os.path.join(track_dir, 'no_vocals.wav'))
 
 
 def to_midi(in_path: str, out_path: Optional[str], onset_threshold=0.5, frame_threshold=0.3, minimum_note_length=58):
@@ -40,3 +63,37 @@ def to_midi(in_path: str, out_path: Optional[str], onset_threshold=0.5, frame_th
             frame_threshold=frame_threshold,
             minimum_note_length=minimum_note_length
         )
+
+
+def to_midi_batch(in_paths: list[str], out_path: str, onset_threshold=0.5, frame_threshold=0.3,
+                  minimum_note_length=58):
+    """
+    Convert several audio files to midi like to_midi, running Basic Pitch on the windows of all files in shared
+    batches. The MIDI files are stored as <out_path>/<name>_basic_pitch.mid like predict_and_save does, but without
+    sonification.
+    :param in_paths: The paths of the audio files
+    :param out_path: The output directory
+    :param onset_threshold:
+    :param frame_threshold:
+    :param minimum_note_length: Min note length in milliseconds
+    """
+    model_outputs = run_inference_batch([load_vocals(path) for path in in_paths])
+    for path, model_output in zip(in_paths, model_outputs):
+        midi_data, _ = extract_notes(model_output, onset_threshold, frame_threshold, minimum_note_length)
+        midi_data.write(os.path.join(out_path, f'{os.path.splitext(os.path.basename(path))[0]}_basic_pitch.mid'))
+
+
+def to_midi_stream(in_path: str, out_path: str, onset_threshold=0.5, frame_threshold=0.3, minimum_note_length=58):
+    """
+    Convert audio to midi like to_midi, but reading and transcribing the file in blocks, so files of any length can be
+    converted with constant memory. The MIDI file is stored as <out_path>/<name>_basic_pitch.mid like
+    predict_and_save does, but without sonification.
+    :param in_path: The path of the audio file, in a format supported by libsndfile
+    :param out_path: The output directory
+    :param onset_threshold:
+    :param frame_threshold:
+    :param minimum_note_length: Min note length in milliseconds
+    """
+    note_events = list(stream_notes(read_blocks(in_path), onset_threshold, frame_threshold, minimum_note_length))
+    midi_data = note_events_to_midi(note_events)
+    midi_data.write(os.path.join(out_path, f'{os.path.splitext(os.path.basename(in_path))[0]}_basic_pitch.mid'))
@@ -0,0 +1,99 @@
+import gc
+import threading
+
+
+def load_basic_pitch_model():
+    # TF is only imported when the model is loaded, so importing this module stays fast
+    import tensorflow as tf
+    from basic_pitch import ICASSP_2022_MODEL_PATH
+    return tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))
+
+
+def load_metricgan_model():
+    from speechbrain.pretrained import SpectralMaskEnhancement
+    return SpectralMaskEnhancement.from_hparams(
+        source="speechbrain/metricgan-plus-voicebank",
+        savedir="models/metricgan-plus-voicebank",
+    )
+
+
+def load_mtl_model():
+    from speechbrain.pretrained import WaveformEnhancement
+    return WaveformEnhancement.from_hparams(
+        source="speechbrain/mtl-mimic-voicebank",
+        savedir="models/mtl-mimic-voicebank",
+    )
+
+
+def load_demucs_model():
+    from demucs.pretrained import get_model
+    # Bag of four fine-tuned Hybrid Transformer Demucs models, one per source
+    model = get_model('htdemucs_ft')
+    model.cpu()
+    model.eval()
+    return model
+
+
+class ModelRegistry:
+    """
+    Thread-safe registry that loads every model the first time it is used and shares it between the threads of a
+    process afterwards. Models that are known to be needed can be preloaded, and models that are not needed anymore
+    can be unloaded to free their memory.
+    Worker processes are spawned, since TF and torch are not fork-safe, so they don't inherit the models of the parent
+    process. Every worker loads its models itself, e.g. in the initializer of the pool.
+    """
+
+    def __init__(self, loaders: dict):
+        """
+        :param loaders: The functions loading the models by model name
+        """
+        self._loaders = loaders
+        self._models = {}
+        # Every model has its own lock, so loading one model doesn't block using another one
+        self._locks = {name: threading.Lock() for name in loaders}
+
+    def get(self, name: str):
+        """
+        Get a model, loading it if it hasn't been loaded yet
+        :param name: The name of the model
+        :return: The loaded model
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        if name not in self._loaders:
+            raise ValueError(f"Unknown model: {name}")
+        with self._locks[name]:
+            # Another thread may have loaded the model while waiting for the lock
+            if name not in self._models:
+                self._models[name] = self._loaders[name]()
+            return self._models[name]
+
+    def preload(self, *names: str):
+        """
+        Load the given models now instead of on first use
+        :param names: The names of the models. If none are given, all models are loaded.
+        """
+        for name in names or self._loaders:
+            self.get(name)
+
+    def unload(self, *names: str):
+        """
+        Drop the given models, so their memory can be freed. They are loaded again when they are used the next time.
+        :param names: The names of the models. If none are given, all models are unloaded.
+        """
+        for name in names or self._loaders:
+            with self._locks[name]:
+                self._models.pop(name, None)
+        gc.collect()
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+
+models = ModelRegistry({
+    'basic_pitch': load_basic_pitch_model,
+    'metricgan': load_metricgan_model,
+    'mtl': load_mtl_model,
+    'demucs': load_demucs_model,
+})
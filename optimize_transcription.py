@@ -1,91 +1,396 @@
+import multiprocessing
 import os.path
 import random
 import shutil
+import tempfile
+import time
+from multiprocessing.util import Finalize
 
-import pretty_midi
-from skopt import gp_minimize
+from skopt import gp_minimize, Optimizer
 from skopt.space import Real, Integer, Categorical
+from skopt.utils import cook_estimator, create_result, normalize_dimensions
+from sklearn.utils import check_random_state
 
-from evaluate_midi import prepare_eval_data, evaluate, EvalData
+from activation_cache import ActivationCache
+from audio_store import AudioStore
+from evaluate_midi import prepare_eval_data, f_measure
+from instrumentation import PROFILE_ENV, append_profile, collect, configure, is_enabled, record, stage
+from models import models
+from reference_index import ReferenceIndex
+from trial_store import TrialStore, to_points
 
 # Monkey patch numpy to avoid skopt error
 # (see https://github.com/scikit-optimize/scikit-optimize/issues/1138 for details)
 import numpy
 
-from transcription import transcribe_vocals
+from transcription import transcribe_vocals_batch, working_sample_rate
 
 numpy.int = int
 
 songs_path = 'data/test'
+# Precomputed reference notes of all songs, rebuilt automatically when a reference MIDI file changes
+reference_index_path = 'cache/references.npz'
 iterations = 100
 batch_size = 30
+# Basic Pitch model outputs are cached, so trials that only change the note extraction thresholds skip inference
+activation_cache_dir = 'cache/activations'
+activation_cache_size = 8 * 1024 ** 3
+# The vocals of all songs are decoded once per working sample rate into memory-mapped stores, rebuilt automatically
+# when a vocals file changes. None decodes the vocals of every song on every evaluation.
+audio_store_dir = 'cache/audio'
+# Number of worker processes the songs of a step are distributed to (1 evaluates all songs in the main process)
+workers = 1
+# Number of TF/torch threads each worker process may use
+threads_per_worker = 1
+# Maximum number of songs a process transcribes together, so Basic Pitch runs on the windows of all of them at once
+# (1 runs the inference song by song)
+songs_per_inference_batch = 8
+# Number of candidates proposed and evaluated concurrently per round (1 uses the sequential gp_minimize)
+candidates_per_round = 1
+# Strategy for proposing several candidates at once, see skopt.Optimizer.ask (cl_min, cl_mean or cl_max)
+batch_strategy = 'cl_min'
+# Seed for the optimizer and the song sampling, None for non-reproducible runs
+random_seed = None
+# Every evaluated trial is appended to this file, so runs can be resumed after a crash
+trials_path = 'results/trials.jsonl'
+# Record the time and memory of every stage of the transcription (also enabled by the TRANSCRIPTION_PROFILE environment
+# variable). The profiles of every trial are appended to profile_path, see instrumentation.py for a summary report.
+profile = False
+profile_path = os.path.splitext(trials_path)[0] + '.profile.jsonl'
+# Name of the run. If the trials file already contains trials of a run with this name, the run is resumed.
+run_name = 'default'
+# Names of earlier runs whose trials are used to warm-start the optimization (trials outside the bounds are skipped)
+warm_start_runs = []
+# Number of random points evaluated before the optimizer starts fitting its model (as in gp_minimize)
+n_initial_points = 10
+# Successive halving scores the candidates on halving_min_songs songs first and only promotes the best
+# 1/halving_eta of them to halving_eta times as many songs, until they are scored on the full batch_size
+successive_halving = False
+halving_min_songs = 5
+halving_eta = 3
+# Budget of a successive halving run in song transcriptions (instead of optimizer calls)
+song_budget = iterations * batch_size
 
 progress = {
     'step': 0,
 }
 
+# Per-process state, set up once by init_worker
+worker_state = {}
 
-def optimize_transcription(songs: list):
-    def evaluate_transcription(vocals_path: str, ref_notes: EvalData, params):
-        tmp_dir = os.path.join(os.getcwd(), "transcription_tmp")
-        os.mkdir(tmp_dir)
-        est_notes = transcribe_vocals(
-            vocals_path, tmp_dir,
-            params[0], params[1], params[2], params[3], params[4], params[5],
-            params[6], params[7], params[8], params[9], params[10], params[11],
-        )
-        shutil.rmtree(tmp_dir)
+# Parameter ranges for prediction options
+param_ranges = [
+    # Noise gate
+    Real(-32.0, -6.0, name="noise_gate_threshold"),
+    Real(70.0, 1000.0, name="noise_gate_attack"),  # 1/16 - 1/2 note
+    Real(500.0, 2000.0, name="noise_gate_release"),  # 1/4 - 1 note
+    # Lowpass filter
+    Real(80.0, 1500.0, name="lowpass_cutoff"),  # Lowest vocal frequency - include some overtones
+    # Compressor
+    Real(-18.0, -3.0, name="compressor_threshold"),
+    Real(2.0, 10.0, name="compressor_ratio"),
+    Real(1.0, 80.0, name="compressor_attack"),  # 1 ms - little more than 1/16 note
+    Real(80.0, 500.0, name="compressor_release"),  # little more than 1/16 note - 1/4 note
+    # ML model
+    Categorical([None, "metricgan", "mtl"], name="ml_model"),
+    # Basic Pitch
+    Real(0.2, 0.8, name="basic_pitch_onset_threshold"),
+    Real(0.2, 0.8, name="basic_pitch_frame_threshold"),
+    Integer(80, 250, name="basic_pitch_minimum_note_length")
+]
+
+
+def get_sample_rates() -> set[int]:
+    # The sample rates the vocals are decoded at for the ML models of the search space
+    ml_models = next(dimension for dimension in param_ranges if dimension.name == 'ml_model').categories
+    return {working_sample_rate(ml_model) for ml_model in ml_models}
+
+
+def init_worker(threads: int = None):
+    """
+    Set up the current process for evaluating transcriptions.
+    Spawned workers don't inherit the models of the main process, so every worker preloads its own Basic Pitch model
+    here. The enhancement models are loaded once per process when they are first used.
+    :param threads: The number of torch threads of a worker process, None when evaluating in the main process.
+    The TF thread pools can only be sized before TF is initialized, so they are configured by create_worker_pool.
+    """
+    if threads is not None:
+        # torch is only imported in the workers, so importing this module stays fast
+        import torch
+        torch.set_num_threads(threads)
+        # Give every worker its own scratch space for temporary files
+        scratch_dir = tempfile.mkdtemp(prefix='transcription_worker_')
+        tempfile.tempdir = scratch_dir
+        Finalize(None, shutil.rmtree, args=(scratch_dir,), kwargs={'ignore_errors': True}, exitpriority=0)
+    models.preload('basic_pitch')
+    worker_state['activation_cache'] = ActivationCache(activation_cache_dir, activation_cache_size)
+    worker_state['references'] = ReferenceIndex.load(reference_index_path)
+    # Every process maps the same files, so the decoded audio is only kept in memory once
+    worker_state['audio_stores'] = {sample_rate: AudioStore.load(audio_store_dir, sample_rate)
+                                    for sample_rate in get_sample_rates()} if audio_store_dir else {}
+
+
+def create_worker_pool(processes: int, threads: int):
+    """
+    Create a pool of worker processes for evaluating songs in parallel
+    :param processes: The number of worker processes
+    :param threads: The number of TF/torch threads per worker process
+    :return: The worker pool
+    """
+    # Spawned workers inherit the environment, which TF reads when it is initialized
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    if is_enabled():
+        os.environ.setdefault(PROFILE_ENV, '1')
+    # TF and torch are not fork-safe once initialized, so the workers have to be spawned
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(processes, initializer=init_worker, initargs=(threads,))
+
+
+def evaluate_transcription(song: dict, params) -> tuple[float, float, dict | None]:
+    """
+    Transcribe a song using the given parameters and score the result
+    :param song: The song containing its name and the path of the vocals
+    :param params: The parameters for transcribe_vocals
+    :return: The score (1 - F-measure), the time needed for evaluating the song in seconds and the profile of the
+    evaluation, which is None if the instrumentation is disabled
+    """
+    return evaluate_transcription_batch([(song, params)])[0]
+
+
+def evaluate_transcription_batch(batch: list) -> list[tuple[float, float, dict | None]]:
+    """
+    Transcribe several songs, each with its own parameters, and score the results.
+    Basic Pitch runs on the windows of all songs at once, so the time of the batch is split evenly between its songs,
+    and the profile of the batch is returned with the first song.
+    :param batch: The (song, params) pairs, see evaluate_transcription
+    :return: The score, the time and the profile of every song, see evaluate_transcription
+    """
+    start_time = time.perf_counter()
+    # Discard anything recorded outside of the evaluation of the songs, e.g. while setting up the worker
+    collect()
+    param_names = [dimension.name for dimension in param_ranges]
+    transcriptions = []
+    for song, params in batch:
+        kwargs = dict(zip(param_names, params))
+        audio_store = worker_state['audio_stores'].get(working_sample_rate(kwargs['ml_model']))
+        if audio_store is not None and song["name"] in audio_store:
+            kwargs['audio'] = audio_store[song["name"]]
+        transcriptions.append({'vocals_path': song["vocals"], **kwargs})
+    all_est_notes = transcribe_vocals_batch(transcriptions, activation_cache=worker_state['activation_cache'])
+
+    scores = []
+    for (song, _), est_notes in zip(batch, all_est_notes):
         if len(est_notes) == 0:
             # optimization is trying to minimize the result
             # return max value to indicate invalid result
-            return 1
-        scores = evaluate(ref_notes, prepare_eval_data(est_notes))
-        return 1.0 - scores['F-measure']
+            scores.append(1)
+            continue
+        with stage('evaluate'):
+            scores.append(1.0 - f_measure(worker_state['references'][song["name"]], prepare_eval_data(est_notes)))
+    seconds = (time.perf_counter() - start_time) / len(batch)
+    profiles = [collect()] + [None] * (len(batch) - 1)
+    return [(score, seconds, song_profile) for score, song_profile in zip(scores, profiles)]
+
+
+def evaluate_songs(batch: list, pool=None, processes: int = 1) -> list:
+    """
+    Evaluate songs in batches of up to songs_per_inference_batch songs, distributing the batches to the workers
+    :param batch: The (song, params) pairs, see evaluate_transcription
+    :param pool: The worker pool, or None to evaluate the songs in the current process
+    :param processes: The number of worker processes, so the songs are split into at least one batch per worker
+    :return: The results of evaluate_transcription for all songs, in the order of the batch
+    """
+    if not batch:
+        return []
+    size = max(1, min(songs_per_inference_batch, -(-len(batch) // processes)))
+    chunks = [batch[start:start + size] for start in range(0, len(batch), size)]
+    if pool is None:
+        chunk_results = [evaluate_transcription_batch(chunk) for chunk in chunks]
+    else:
+        # Results are returned in the order of the chunks, so they are aggregated exactly like before
+        chunk_results = pool.map(evaluate_transcription_batch, chunks, chunksize=1)
+    return [result for results in chunk_results for result in results]
+
 
-    def load_reference_notes(notes_path: str):
-        midi = pretty_midi.PrettyMIDI(notes_path)
-        original_midi = midi.instruments[0].notes
-        return prepare_eval_data(original_midi)
+def optimize_transcription(songs: list):
+    if profile:
+        configure(enabled=True)
+    pool = None
+    if workers > 1:
+        pool = create_worker_pool(workers, threads_per_worker)
+    else:
+        init_worker()
+
+    song_rng = random.Random(random_seed)
+    store = TrialStore(trials_path)
+
+    # Resume the run and warm-start it with the trials of earlier runs
+    resumed_rows = store.load([run_name])
+    resumed_x, resumed_y = to_points(resumed_rows, param_ranges)
+    x0, y0 = to_points(store.load(warm_start_runs), param_ranges)
+    x0 += resumed_x
+    y0 += resumed_y
+    progress['step'] = len(resumed_x)
+    if x0:
+        print(f'Resuming after {len(resumed_x)} trials, warm-starting with {len(x0) - len(resumed_x)} trials')
+
+    def store_trial(params, song_batch: list, results: list, seconds: float, main_profile: dict = None):
+        # Convert numpy values, so the parameters can be serialized
+        params = {dimension.name: value.item() if isinstance(value, numpy.generic) else value
+                  for dimension, value in zip(param_ranges, params)}
+        song_results = [{'song': song['name'], 'score': score, 'seconds': song_seconds}
+                        for song, (score, song_seconds, _) in zip(song_batch, results)]
+        score = sum(result[0] for result in results) / len(results)
+        store.append(run_name, params, score, song_results, seconds)
+        if is_enabled():
+            song_profiles = [{'song': song['name'], **song_profile} if song_profile is not None else None
+                             for song, (_, _, song_profile) in zip(song_batch, results)]
+            append_profile(profile_path, {'run': run_name, 'step': progress['step'], 'time': time.time(),
+                                          'score': score, 'seconds': seconds, 'songs': song_profiles,
+                                          'main': main_profile})
+        return score
+
+    def evaluate_jobs(jobs: list) -> list:
+        # Evaluate (params, songs) jobs together, so all of their songs can be distributed to the workers at once
+        batch = [(song, list(params)) for params, job_songs in jobs for song in job_songs]
+        results = evaluate_songs(batch, pool, workers)
+        job_results = []
+        for _, job_songs in jobs:
+            job_results.append(results[:len(job_songs)])
+            results = results[len(job_songs):]
+        return job_results
+
+    # End of the last evaluation, the time until the next evaluation is spent by the optimizer proposing candidates
+    last_evaluation = {'end': None}
+
+    def evaluate_candidates(candidates: list) -> list:
+        start_time = time.perf_counter()
+        if last_evaluation['end'] is not None:
+            record('optimizer', start_time - last_evaluation['end'])
+        # Collected before the evaluation, since the songs may be evaluated in the main process as well
+        main_profile = collect()
+        # Sample the songs of all candidates up front, so the samples don't depend on the evaluation order
+        jobs = [(params, song_rng.sample(songs, batch_size)) for params in candidates]
+        job_results = evaluate_jobs(jobs)
+        seconds = time.perf_counter() - start_time
+        # The main process profile is stored with the first candidate of the round
+        main_profiles = [main_profile] + [None] * (len(jobs) - 1)
+        scores = [store_trial(params, job_songs, results, seconds, main_profile)
+                  for (params, job_songs), results, main_profile in zip(jobs, job_results, main_profiles)]
+        last_evaluation['end'] = time.perf_counter()
+        return scores
 
     def evaluate_transcriptions(params):
         progress['step'] += 1
         print(f"Step {progress['step']} of {iterations}")
-        results = []
-        for song in random.sample(songs, batch_size):
-            ref_notes = load_reference_notes(song["notes"])
-            result = evaluate_transcription(song["vocals"], ref_notes, params)
-            results.append(result)
-        return sum(results) / len(results)
-
-    # Parameter ranges for prediction options
-    param_ranges = [
-        # Noise gate
-        Real(-32.0, -6.0, name="noise_gate_threshold"),
-        Real(70.0, 1000.0, name="noise_gate_attack"),  # 1/16 - 1/2 note
-        Real(500.0, 2000.0, name="noise_gate_release"),  # 1/4 - 1 note
-        # Lowpass filter
-        Real(80.0, 1500.0, name="lowpass_cutoff"),  # Lowest vocal frequency - include some overtones
-        # Compressor
-        Real(-18.0, -3.0, name="compressor_threshold"),
-        Real(2.0, 10.0, name="compressor_ratio"),
-        Real(1.0, 80.0, name="compressor_attack"),  # 1 ms - little more than 1/16 note
-        Real(80.0, 500.0, name="compressor_release"),  # little more than 1/16 note - 1/4 note
-        # ML model
-        Categorical([None, "metricgan", "mtl"], name="ml_model"),
-        # Basic Pitch
-        Real(0.2, 0.8, name="basic_pitch_onset_threshold"),
-        Real(0.2, 0.8, name="basic_pitch_frame_threshold"),
-        Integer(80, 250, name="basic_pitch_minimum_note_length")
-    ]
-
-    results = gp_minimize(evaluate_transcriptions, param_ranges, n_calls=iterations)
-    print(results)
+        return evaluate_candidates([params])[0]
+
+    def create_optimizer():
+        # Same setup as gp_minimize, but using the ask/tell interface to propose several candidates per round
+        rng = check_random_state(random_seed)
+        space = normalize_dimensions(param_ranges)
+        base_estimator = cook_estimator(
+            "GP", space=space, random_state=rng.randint(0, numpy.iinfo(numpy.int32).max), noise="gaussian",
+        )
+        # Telling x0 counts the points towards the initial points, like in gp_minimize
+        return Optimizer(
+            space, base_estimator,
+            n_initial_points=n_initial_points, acq_optimizer="lbfgs", random_state=rng,
+        )
+
+    def get_stored_result():
+        # Result of the stored trials of the run, e.g. when resuming a run that has already finished
+        if not resumed_x:
+            return None
+        return create_result(resumed_x, resumed_y, normalize_dimensions(param_ranges))
+
+    def minimize_batched():
+        optimizer = create_optimizer()
+        result = optimizer.tell(x0, y0) if x0 else None
+        while progress['step'] < iterations:
+            n_points = min(candidates_per_round, iterations - progress['step'])
+            print(f"Steps {progress['step'] + 1}-{progress['step'] + n_points} of {iterations}")
+            progress['step'] += n_points
+            candidates = optimizer.ask(n_points=n_points, strategy=batch_strategy)
+            result = optimizer.tell(candidates, evaluate_candidates(candidates))
+        return result
+
+    def minimize_successive_halving():
+        # Number of songs the candidates are scored on in each rung, e.g. 5, 15 and 30 songs
+        rungs = [min(halving_min_songs, batch_size)]
+        while rungs[-1] < batch_size:
+            rungs.append(min(rungs[-1] * halving_eta, batch_size))
+        # Start with enough candidates to promote a single one to the full batch
+        n_candidates = halving_eta ** (len(rungs) - 1)
+        spent = sum(len(row['songs']) for row in resumed_rows)
+
+        optimizer = create_optimizer()
+        result = optimizer.tell(x0, y0) if x0 else None
+        while spent < song_budget:
+            print(f"Bracket of {n_candidates} candidates, {spent} of {song_budget} song transcriptions used")
+            start_time = time.perf_counter()
+            with stage('optimizer'):
+                candidates = optimizer.ask(n_points=n_candidates, strategy=batch_strategy)
+            main_profiles = [collect()] + [None] * (len(candidates) - 1)
+            samples = [song_rng.sample(songs, batch_size) for _ in candidates]
+            results = [[] for _ in candidates]
+            active = list(range(len(candidates)))
+            for rung, rung_songs in enumerate(rungs):
+                # Only the songs a candidate hasn't been scored on yet are evaluated
+                jobs = [(candidates[i], samples[i][len(results[i]):rung_songs]) for i in active]
+                for i, job_results in zip(active, evaluate_jobs(jobs)):
+                    results[i] += job_results
+                spent += sum(len(job_songs) for _, job_songs in jobs)
+                if rung < len(rungs) - 1:
+                    # Promote the best candidates to the next rung
+                    active.sort(key=lambda i: sum(result[0] for result in results[i]) / len(results[i]))
+                    active = active[:max(1, len(active) // halving_eta)]
+            seconds = time.perf_counter() - start_time
+
+            # Candidates that were stopped early are reported with the score of the songs they were evaluated on
+            scores = [store_trial(params, sample[:len(song_results)], song_results, seconds, main_profile)
+                      for params, sample, song_results, main_profile
+                      in zip(candidates, samples, results, main_profiles)]
+            progress['step'] += len(candidates)
+            with stage('optimizer'):
+                result = optimizer.tell(candidates, scores)
+        return result
+
+    try:
+        if successive_halving:
+            results = minimize_successive_halving()
+        elif candidates_per_round > 1:
+            results = minimize_batched()
+        elif progress['step'] >= iterations:
+            # gp_minimize doesn't accept a run without any calls left
+            results = get_stored_result()
+        else:
+            results = gp_minimize(
+                evaluate_transcriptions, param_ranges,
+                n_calls=iterations - progress['step'],
+                n_initial_points=max(0, n_initial_points - len(x0)),
+                x0=x0 or None, y0=y0 or None,
+                random_state=random_seed,
+            )
+    finally:
+        if pool is not None:
+            # Close instead of terminate, so the workers clean up their scratch directories
+            pool.close()
+            pool.join()
+    # Without any stored or evaluated trials, e.g. with iterations = 0, there is no result
+    print(results if results is not None else 'No trials were evaluated')
 
 
 if __name__ == "__main__":
     full_songs_path = os.path.join(os.getcwd(), songs_path)
-    songs = [{'vocals': os.path.join(full_songs_path, song, 'vocals.wav'),
-              'notes': os.path.join(full_songs_path, song, f'{song}.mid')} for song
-             in os.listdir(full_songs_path)]
+    references = ReferenceIndex.load_or_build(full_songs_path, reference_index_path)
+    if audio_store_dir:
+        for sample_rate in sorted(get_sample_rates()):
+            AudioStore.load_or_build(full_songs_path, audio_store_dir, sample_rate)
+    songs = [{'name': song,
+              'vocals': os.path.join(full_songs_path, song, 'vocals.wav')} for song
+             in references.names.tolist()]
     print(f'optimizing over {len(songs)} songs')
     optimize_transcription(songs)
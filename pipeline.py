@@ -0,0 +1,184 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from models import models
+from separation import load_track, separate_vocals, set_threads
+from transcription import condition_audio, extract_notes, resample, run_inference, working_sample_rate
+
+input_dir = 'data/songs/'
+output_dir = 'data/out/pipeline/'
+# Maximum number of songs waiting between two stages, which bounds the memory needed for the audio in flight
+queue_size = 2
+# Number of torch threads used by the separation (None uses the torch default)
+separation_threads = None
+audio_extensions = ('.mp3', '.wav', '.flac', '.ogg', '.m4a')
+
+# Parameters of the audio conditioning, see transcription.condition_audio
+conditioning_params = {
+    'noise_gate_threshold': -18.0,
+    'noise_gate_attack': 500.0,
+    'noise_gate_release': 1500.0,
+    'lowpass_cutoff': 500.0,
+    'compressor_threshold': -6.0,
+    'compressor_ratio': 5.0,
+    'compressor_attack': 1.0,
+    'compressor_release': 100.0,
+    'ml_model': None,
+}
+# Parameters of the note extraction, see transcription.extract_notes
+note_params = {
+    'basic_pitch_onset_threshold': 0.5,
+    'basic_pitch_frame_threshold': 0.3,
+    'basic_pitch_minimum_note_length': 127.7,
+}
+
+
+def list_songs(input_dir: str) -> dict:
+    """
+    Find all audio files in a directory and its subdirectories
+    :param input_dir: The directory
+    :return: The paths of the audio files by song name. The name is the path relative to the directory without the
+    extension, so songs with the same file name in different subdirectories are kept apart.
+    :raises ValueError: If a directory contains several audio files of the same song, e.g. an MP3 and a WAVE file
+    """
+    songs = {}
+    for root, _, files in os.walk(input_dir, onerror=print):
+        for file in sorted(files):
+            stem, extension = os.path.splitext(file)
+            if extension.lower() in audio_extensions:
+                name = os.path.relpath(os.path.join(root, stem), input_dir)
+                path = os.path.join(root, file)
+                if name in songs:
+                    raise ValueError(f'Several audio files of the song {name}: {songs[name]} and {path}')
+                songs[name] = path
+    return songs
+
+
+def get_params() -> dict:
+    return {**conditioning_params, **note_params}
+
+
+def get_output_path(name: str, extension: str) -> str:
+    # Every song gets its own output directory, the subdirectories of the input directory are kept
+    return os.path.join(output_dir, name, f'{os.path.basename(name)}{extension}')
+
+
+def is_completed(name: str) -> bool:
+    # The parameters are written last, so they only exist if all outputs of the song are complete
+    params_path = get_output_path(name, '.json')
+    if not os.path.exists(params_path):
+        return False
+    with open(params_path) as params_file:
+        return json.load(params_file) == get_params()
+
+
+def write_outputs(name: str, midi_data, note_events: list):
+    """
+    Write the transcription of a song: the MIDI file, the note arrays and the parameters used
+    :param name: The name of the song
+    :param midi_data: The transcribed PrettyMIDI object
+    :param note_events: The transcribed Basic Pitch note events
+    """
+    os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+    midi_data.write(get_output_path(name, '.mid'))
+    np.savez(
+        get_output_path(name, '.npz'),
+        starts=np.array([event[0] for event in note_events], dtype=np.float64),
+        ends=np.array([event[1] for event in note_events], dtype=np.float64),
+        pitches=np.array([event[2] for event in note_events], dtype=np.int64),
+        amplitudes=np.array([event[3] for event in note_events], dtype=np.float64),
+    )
+    params_path = get_output_path(name, '.json')
+    with open(f'{params_path}.tmp', 'w') as params_file:
+        json.dump(get_params(), params_file, indent=2)
+    os.replace(f'{params_path}.tmp', params_path)
+
+
+def separate(name: str, path: str):
+    # The separation model runs at 44.1 kHz stereo, the vocals are downmixed by the next stage
+    return separate_vocals(load_track(path)), models.get('demucs').samplerate
+
+
+def condition(name: str, separated: tuple):
+    vocals, sample_rate = separated
+    # Downmix and resample only once, to the sample rate the conditioning runs at
+    target_rate = working_sample_rate(conditioning_params['ml_model'])
+    mono = resample(vocals.mean(axis=0), sample_rate, target_rate)
+    return condition_audio(mono, target_rate, **conditioning_params)
+
+
+def transcribe(name: str, samples: np.ndarray):
+    midi_data, note_events = extract_notes(run_inference(samples), **note_params)
+    write_outputs(name, midi_data, note_events)
+    print(f'Transcribed {name} ({len(note_events)} notes)')
+
+
+def run_stage(stage, in_queue: queue.Queue, out_queue: queue.Queue | None, failed: list):
+    """
+    Process the songs of a queue until it is closed with None, passing the results to the next stage
+    :param stage: The function processing a single song, taking the song name and the result of the previous stage
+    :param in_queue: The queue of the songs to process
+    :param out_queue: The queue of the next stage, or None for the last stage
+    :param failed: The list the names of failed songs are added to
+    """
+    while (item := in_queue.get()) is not None:
+        name, data = item
+        try:
+            result = stage(name, data)
+        except Exception as e:
+            print(f'{stage.__name__} failed for {name}: {e}')
+            failed.append(name)
+            continue
+        if out_queue is not None:
+            out_queue.put((name, result))
+    if out_queue is not None:
+        out_queue.put(None)
+
+
+def run_pipeline(input_dir: str):
+    """
+    Separate and transcribe all songs of a library.
+    Separation (torch), conditioning (pedalboard) and Basic Pitch (TF) run in their own threads, connected by
+    bounded queues, so the stages of different songs overlap. The heavy work of all stages releases the GIL.
+    The outputs of every song are written as soon as it is transcribed, songs that were already transcribed with the
+    same parameters are skipped.
+    :param input_dir: The directory containing the audio files of the songs
+    """
+    songs = list_songs(input_dir)
+    pending = {name: path for name, path in songs.items() if not is_completed(name)}
+    print(f'Transcribing {len(pending)} of {len(songs)} songs, {len(songs) - len(pending)} are already transcribed')
+    if not pending:
+        return
+
+    set_threads(separation_threads)
+    queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in range(2)]
+    failed = []
+    stages = [separate, condition, transcribe]
+    threads = [
+        threading.Thread(target=run_stage, args=(stage, queues[i], queues[i + 1] if i + 1 < len(queues) else None,
+                                                 failed), name=stage.__name__)
+        for i, stage in enumerate(stages)
+    ]
+
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for item in pending.items():
+        queues[0].put(item)
+    queues[0].put(None)
+    for thread in threads:
+        thread.join()
+
+    seconds = time.time() - start_time
+    completed = len(pending) - len(failed)
+    print(f'Transcribed {completed} songs in {seconds:.1f}s ({completed / seconds:.2f} songs/s), '
+          f'{len(failed)} failed: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    run_pipeline(input_dir)
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pretty_midi
+
+from evaluate_midi import EvalData
+from file_index import INDEX_LOAD_ERRORS, atomic_write, files_unchanged, get_file_stats, list_song_files
+
+
+def list_reference_files(songs_path: str) -> dict:
+    """
+    Find the reference MIDI files of all songs in a directory.
+    Every song is expected in its own subdirectory containing a MIDI file named after the song.
+    :param songs_path: The songs directory
+    :return: The paths of the MIDI files by song name
+    """
+    return list_song_files(songs_path, '{name}.mid')
+
+
+class ReferenceIndex:
+    """
+    Precomputed reference notes of all songs in a directory.
+    The pitches and intervals of all songs are stored as concatenated arrays with per-song offsets in a single .npz
+    file, so looking up the notes of a song doesn't require parsing its MIDI file.
+    The index stores the modification time and size of every MIDI file and is rebuilt if any of them changed.
+    """
+
+    def __init__(self, names: np.ndarray, offsets: np.ndarray, pitches: np.ndarray, intervals: np.ndarray,
+                 mtimes: np.ndarray, sizes: np.ndarray):
+        self.names = names
+        self.offsets = offsets
+        self.pitches = pitches
+        self.intervals = intervals
+        self.mtimes = mtimes
+        self.sizes = sizes
+        self._positions = {name: i for i, name in enumerate(names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name: str):
+        return name in self._positions
+
+    def __getitem__(self, name: str) -> EvalData:
+        """
+        Get the reference notes of a song
+        :param name: The name of the song
+        :return: The reference notes as views into the index arrays
+        """
+        position = self._positions[name]
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return EvalData(self.pitches[start:end], self.intervals[start:end])
+
+    def is_up_to_date(self, reference_files: dict) -> bool:
+        """
+        Check whether the index matches the given reference files
+        :param reference_files: The paths of the MIDI files by song name
+        :return: True if the index contains exactly these songs and none of the files changed, otherwise False
+        """
+        return files_unchanged(reference_files, self._positions, self.mtimes, self.sizes)
+
+    def save(self, index_path: str):
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        with atomic_write(index_path) as tmp_path:
+            np.savez(
+                tmp_path,
+                names=self.names,
+                offsets=self.offsets,
+                pitches=self.pitches,
+                intervals=self.intervals,
+                mtimes=self.mtimes,
+                sizes=self.sizes,
+            )
+
+    @classmethod
+    def load(cls, index_path: str) -> 'ReferenceIndex':
+        with np.load(index_path) as index:
+            return cls(
+                index['names'],
+                index['offsets'],
+                index['pitches'],
+                index['intervals'],
+                index['mtimes'],
+                index['sizes'],
+            )
+
+    @classmethod
+    def build(cls, reference_files: dict) -> 'ReferenceIndex':
+        """
+        Parse the given reference files and build an index from them
+        :param reference_files: The paths of the MIDI files by song name
+        :return: The reference index
+        """
+        names = sorted(reference_files)
+        pitches = []
+        intervals = []
+        offsets = [0]
+        mtimes = []
+        sizes = []
+        for name in names:
+            path = reference_files[name]
+            mtime, size = get_file_stats(path)
+            midi = pretty_midi.PrettyMIDI(path)
+            eval_data = EvalData.from_instrument(midi.instruments[0]) if midi.instruments else EvalData()
+            pitches.append(eval_data.pitches)
+            intervals.append(eval_data.intervals)
+            offsets.append(offsets[-1] + len(eval_data.pitches))
+            mtimes.append(mtime)
+            sizes.append(size)
+        return cls(
+            np.array(names, dtype=str),
+            np.array(offsets, dtype=np.int64),
+            np.concatenate(pitches).astype(np.int64) if pitches else np.zeros(0, dtype=np.int64),
+            np.concatenate(intervals).astype(np.float64) if intervals else np.zeros((0, 2), dtype=np.float64),
+            np.array(mtimes, dtype=np.int64),
+            np.array(sizes, dtype=np.int64),
+        )
+
+    @classmethod
+    def load_or_build(cls, songs_path: str, index_path: str) -> 'ReferenceIndex':
+        """
+        Load the reference index of a songs directory and rebuild it if it is missing or out of date
+        :param songs_path: The songs directory
+        :param index_path: The path of the index file
+        :return: The up-to-date reference index
+        """
+        reference_files = list_reference_files(songs_path)
+        try:
+            index = cls.load(index_path)
+            if index.is_up_to_date(reference_files):
+                return index
+        except INDEX_LOAD_ERRORS:
+            # Missing or corrupt indexes are rebuilt
+            pass
+        print(f'Building reference index for {len(reference_files)} songs in {songs_path}')
+        index = cls.build(reference_files)
+        index.save(index_path)
+        return index
@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+
+from models import models
+
+# Length of the parts long tracks are separated in, so the memory needed doesn't grow with the length of the track
+CHUNK_SECONDS = 60.0
+# Length of the crossfade between two consecutive parts
+CROSSFADE_SECONDS = 5.0
+
+
+def set_threads(threads: int = None):
+    """
+    Set the number of threads torch uses for the separation
+    :param threads: The number of threads. If None, the torch default is kept.
+    """
+    if threads is not None:
+        import torch
+        torch.set_num_threads(threads)
+
+
+def load_track(path: str):
+    """
+    Load a track with the sample rate and number of channels of the separation model
+    :param path: The path of the audio file
+    :return: The samples as tensor with shape (channels, samples)
+    """
+    from demucs.separate import load_track as load_demucs_track
+    model = models.get('demucs')
+    return load_demucs_track(path, model.audio_channels, model.samplerate)
+
+
+def separate_vocals(
+        mix,
+        segment: float = None,
+        overlap: float = 0.25,
+        shifts: int = 1,
+        jobs: int = 0,
+        chunk_seconds: float = CHUNK_SECONDS,
+        crossfade_seconds: float = CROSSFADE_SECONDS,
+        return_accompaniment: bool = False,
+):
+    """
+    Separate the vocals of a track with the htdemucs_ft model, which is loaded only once for all tracks.
+    Long tracks are separated in parts of chunk_seconds with a crossfade between them, and only the vocals of every
+    part are kept, so the memory needed is bounded by the length of the parts instead of the length of the track.
+    The track is normalized the same way as by the Demucs CLI.
+    :param mix: The samples of the track as tensor or array with shape (channels, samples), with the sample rate and
+    number of channels of the model, e.g. loaded with load_track
+    :param segment: The length of the segments the model processes at once, in seconds. Uses the model default if None.
+    :param overlap: The overlap of the segments
+    :param shifts: The number of random shifts to average the prediction of, more shifts improve the quality slightly
+    :param jobs: The number of threads processing segments in parallel
+    :param chunk_seconds: The length of the parts the track is separated in
+    :param crossfade_seconds: The length of the crossfade between two parts
+    :param return_accompaniment: Whether the sum of all other sources should be returned as well
+    :return: The vocals as float32 array with shape (channels, samples) at the sample rate of the model. If
+    return_accompaniment is True, the vocals and the accompaniment.
+    """
+    import torch
+    from demucs.apply import apply_model
+
+    model = models.get('demucs')
+    mix = torch.as_tensor(mix, dtype=torch.float32)
+    vocals_index = model.sources.index('vocals')
+
+    reference = mix.mean(0)
+    mean = reference.mean()
+    std = reference.std()
+
+    length = mix.shape[-1]
+    chunk_length = int(chunk_seconds * model.samplerate)
+    crossfade_length = min(int(crossfade_seconds * model.samplerate), chunk_length // 2)
+    vocals = np.zeros(mix.shape, dtype=np.float32)
+    accompaniment = np.zeros(mix.shape, dtype=np.float32) if return_accompaniment else None
+
+    start = 0
+    while start < length:
+        end = min(start + chunk_length, length)
+        with torch.no_grad():
+            sources = apply_model(model, ((mix[:, start:end] - mean) / std)[None], shifts=shifts, split=True,
+                                  overlap=overlap, num_workers=jobs, segment=segment)[0]
+        sources = sources * std + mean
+        parts = [(vocals, sources[vocals_index].numpy())]
+        if return_accompaniment:
+            other_sources = [source for i, source in enumerate(sources) if i != vocals_index]
+            parts.append((accompaniment, torch.stack(other_sources).sum(0).numpy()))
+
+        # Crossfade with the end of the previous part, which overlaps the start of this part
+        fade_length = min(crossfade_length, end - start) if start > 0 else 0
+        fade_in = np.linspace(0, 1, fade_length + 2, dtype=np.float32)[1:-1]
+        for output, part in parts:
+            output[:, start:start + fade_length] *= 1 - fade_in
+            output[:, start:start + fade_length] += part[:, :fade_length] * fade_in
+            output[:, start + fade_length:end] = part[:, fade_length:]
+
+        if end == length:
+            break
+        start = end - crossfade_length
+
+    if return_accompaniment:
+        return vocals, accompaniment
+    return vocals
+
+
+def separate_files(paths: list[str], **kwargs):
+    """
+    Separate the vocals of several tracks, loading the model only once
+    :param paths: The paths of the audio files
+    :param kwargs: The parameters of separate_vocals
+    :return: A generator yielding the path and the separation result of every track
+    """
+    for path in paths:
+        yield path, separate_vocals(load_track(path), **kwargs)
+
+
+def save_audio(samples: np.ndarray, path: str):
+    """
+    Save separated audio as 16 bit WAVE file, rescaling it if it would clip, like the Demucs CLI does
+    :param samples: The samples with shape (channels, samples) at the sample rate of the model
+    :param path: The output path
+    """
+    import torch
+    from demucs.audio import save_audio as save_demucs_audio
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    save_demucs_audio(torch.from_numpy(samples), path, models.get('demucs').samplerate, clip='rescale')
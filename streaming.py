@@ -0,0 +1,314 @@
+import numpy as np
+import soundfile
+import soxr
+from basic_pitch.constants import ANNOT_N_FRAMES, ANNOTATIONS_FPS, AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+from basic_pitch.note_creation import MIDI_OFFSET, get_pitch_bends, output_to_notes_polyphonic
+
+from transcription import HOP_SIZE, N_OVERLAPPING_FRAMES, OVERLAP_LEN, create_board, normalization_gain, run_windows
+
+# Length of the blocks the audio file is read in
+BLOCK_SECONDS = 1.0
+# Number of windows the Basic Pitch model processes at once. Every window adds about 1.65s of activations.
+WINDOW_BATCH_SIZE = 4
+# Notes are only emitted once the activations extend this far past their end, so they can't be extended anymore
+NOTE_MARGIN_SECONDS = 1.0
+# Activations kept before the start of the notes that are not emitted yet, so their onsets are detected like in the
+# whole song
+NOTE_CONTEXT_SECONDS = 1.0
+# Maximum length of the activations kept for the note extraction, which bounds the memory needed. Longer notes are cut.
+MAX_NOTE_BUFFER_SECONDS = 30.0
+# Number of frames below the frame threshold that end a note, see basic_pitch.note_creation.output_to_notes_polyphonic
+ENERGY_TOLERANCE = 11
+# Number of frames the model outputs for every window, without the overlap that is cut off
+FRAMES_PER_WINDOW = ANNOT_N_FRAMES - N_OVERLAPPING_FRAMES
+
+
+def read_blocks(path: str, block_seconds: float = BLOCK_SECONDS, sample_rate: int = AUDIO_SAMPLE_RATE):
+    """
+    Read an audio file in blocks, without decoding the whole file
+    :param path: The path of the audio file, in a format supported by libsndfile
+    :param block_seconds: The length of the blocks
+    :param sample_rate: The sample rate the blocks are resampled to
+    :return: A generator yielding the blocks as mono float32 samples
+    """
+    with soundfile.SoundFile(path) as audio_file:
+        resampler = None
+        if audio_file.samplerate != sample_rate:
+            # The resampler keeps its state between the blocks, so the blocks are resampled without seams
+            resampler = soxr.ResampleStream(audio_file.samplerate, sample_rate, 1, dtype='float32')
+        block_size = max(1, int(block_seconds * audio_file.samplerate))
+        for block in audio_file.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+            block = block.mean(axis=1)
+            if resampler is not None:
+                block = resampler.resample_chunk(block)
+            if len(block):
+                yield block
+        if resampler is not None:
+            tail = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+            if len(tail):
+                yield tail
+
+
+def condition_blocks(
+        path: str,
+        noise_gate_threshold: float = -18.0,
+        noise_gate_attack: float = 500.0,
+        noise_gate_release: float = 1500.0,
+        lowpass_cutoff: float = 500.0,
+        compressor_threshold: float = -6.0,
+        compressor_ratio: float = 5.0,
+        compressor_attack: float = 1.0,
+        compressor_release: float = 100.0,
+        normalization: str = 'two_pass',
+        block_seconds: float = BLOCK_SECONDS,
+):
+    """
+    Read vocals in blocks and condition them like transcription.condition_audio without an ML model.
+    The pedalboard keeps its state between the blocks, so the blocks are processed like the whole song.
+    :param path: The path of the audio file
+    :param normalization: How the peak for the normalization is found. "two_pass" reads the file twice and normalizes
+    to the peak of the whole file like condition_audio. "running" reads the file only once and normalizes every block
+    to the highest peak so far, so the level of the beginning may differ from condition_audio.
+    :param block_seconds: The length of the blocks
+    :return: A generator yielding the conditioned blocks at the Basic Pitch sample rate
+    """
+    if normalization == 'two_pass':
+        peak = max((np.max(np.abs(block)) for block in read_blocks(path, block_seconds)), default=0)
+    elif normalization == 'running':
+        peak = 0
+    else:
+        raise ValueError(f'Unknown normalization: {normalization}')
+
+    board = create_board(
+        noise_gate_threshold, noise_gate_attack, noise_gate_release,
+        lowpass_cutoff,
+        compressor_threshold, compressor_ratio, compressor_attack, compressor_release,
+    )
+    # The pedalboard is prepared again and loses its state when the block size changes, so it always gets blocks of
+    # the same size, and the last block is padded with silence
+    block_size = max(1, int(block_seconds * AUDIO_SAMPLE_RATE))
+    buffer = np.zeros(0, dtype=np.float32)
+    for block in read_blocks(path, block_seconds):
+        if normalization == 'running':
+            peak = max(peak, np.max(np.abs(block)))
+        buffer = np.concatenate([buffer, block * normalization_gain(peak)])
+        while len(buffer) >= block_size:
+            yield board.process(buffer[:block_size], AUDIO_SAMPLE_RATE, reset=False)
+            buffer = buffer[block_size:]
+    if len(buffer):
+        padded = np.concatenate([buffer, np.zeros(block_size - len(buffer), dtype=np.float32)])
+        yield board.process(padded, AUDIO_SAMPLE_RATE, reset=False)[:len(buffer)]
+
+
+def stream_activations(blocks, batch_size: int = WINDOW_BATCH_SIZE):
+    """
+    Run the Basic Pitch model on audio blocks as soon as enough audio for a batch of windows is available.
+    The audio is split into the same overlapping windows as by transcription.run_inference, and the overlap of the
+    windows is cut off the same way.
+    Unlike basic_pitch.inference.unwrap_output, which keeps ANNOTATIONS_FPS frames per second of audio although the
+    model outputs slightly more, the activations of the whole audio are kept, so the end of long files isn't lost.
+    :param blocks: The audio blocks at the Basic Pitch sample rate
+    :param batch_size: The number of windows per batch
+    :return: A generator yielding the activations of the batches, with shape (n_frames, n_freqs)
+    """
+    n_olap = N_OVERLAPPING_FRAMES // 2
+    buffer = np.zeros(OVERLAP_LEN // 2, dtype=np.float32)
+    length = 0
+    windows = []
+    n_frames = 0
+
+    def run_batch(batch_windows: list, max_frames: int = None) -> dict:
+        output = run_windows(np.stack(batch_windows)[:, :, None], batch_size)
+        return {k: v[:, n_olap:-n_olap, :].reshape(-1, v.shape[2])[:max_frames] for k, v in output.items()}
+
+    for block in blocks:
+        length += len(block)
+        buffer = np.concatenate([buffer, block])
+        while len(buffer) >= AUDIO_N_SAMPLES:
+            windows.append(buffer[:AUDIO_N_SAMPLES])
+            buffer = buffer[HOP_SIZE:]
+        if len(windows) >= batch_size:
+            yield run_batch(windows)
+            n_frames += len(windows) * FRAMES_PER_WINDOW
+            windows = []
+
+    if length == 0:
+        return
+    # The remaining windows are padded with silence, like tf.signal.frame pads the end of the audio
+    for start in range(0, len(buffer), HOP_SIZE):
+        window = np.zeros(AUDIO_N_SAMPLES, dtype=np.float32)
+        window[:len(buffer) - start] = buffer[start:start + AUDIO_N_SAMPLES]
+        windows.append(window)
+    # Every window hop of audio results in FRAMES_PER_WINDOW frames, the frames of the padding are cut off
+    yield run_batch(windows, int(np.ceil(length * FRAMES_PER_WINDOW / HOP_SIZE)) - n_frames)
+
+
+def frame_times(frame_indices: np.ndarray) -> np.ndarray:
+    # Same as basic_pitch.note_creation.model_frames_to_time, but only for the given frames, so the times of all
+    # previous frames of a long stream don't have to be computed
+    window_offset = (FFT_HOP / AUDIO_SAMPLE_RATE) * (ANNOT_N_FRAMES - (AUDIO_N_SAMPLES / FFT_HOP)) + 0.0018
+    return frame_indices * FFT_HOP / AUDIO_SAMPLE_RATE - window_offset * np.floor(frame_indices / ANNOT_N_FRAMES)
+
+
+class NoteStream:
+    """
+    Incremental version of basic_pitch.note_creation.model_output_to_notes.
+    The activations are added as they are computed, and the notes are extracted from the activations kept in a
+    buffer. A note is only emitted once the activations extend far enough past its end that it can't be extended
+    anymore. Notes crossing the end of the buffer are kept until more activations are added, so they are extracted as
+    a whole instead of being split up. The buffer is trimmed to the start of the notes that are not emitted yet, so
+    its length doesn't grow with the length of the audio.
+    The results are close to extracting the notes from the activations of the whole song, but can differ slightly:
+    the melodia trick and the onsets inferred from the frames are computed per buffer instead of over the whole song.
+    """
+
+    def __init__(
+            self,
+            basic_pitch_onset_threshold: float = 0.5,
+            basic_pitch_frame_threshold: float = 0.3,
+            basic_pitch_minimum_note_length: float = 127.7,
+            margin_seconds: float = NOTE_MARGIN_SECONDS,
+            context_seconds: float = NOTE_CONTEXT_SECONDS,
+            max_buffer_seconds: float = MAX_NOTE_BUFFER_SECONDS,
+    ):
+        self.onset_threshold = basic_pitch_onset_threshold
+        self.frame_threshold = basic_pitch_frame_threshold
+        # Convert milliseconds to frames like transcription.extract_notes
+        self.minimum_note_length = int(np.round(basic_pitch_minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+        # The extraction of a note stops ENERGY_TOLERANCE frames after its end or at the second to last frame
+        self.margin = max(int(margin_seconds * ANNOTATIONS_FPS), ENERGY_TOLERANCE + 2)
+        self.context = int(context_seconds * ANNOTATIONS_FPS)
+        self.max_buffer = max(int(max_buffer_seconds * ANNOTATIONS_FPS), self.margin + self.context + 1)
+        self.buffer = None
+        # Index of the first frame of the buffer in the whole stream
+        self.start = 0
+        # All notes starting before this frame are emitted
+        self.committed = 0
+        # Emitted notes that overlap the buffer, as (start frame, end frame, pitch)
+        self.emitted = []
+
+    def add(self, activations: dict) -> list:
+        """
+        Add the next activations of the stream
+        :param activations: The unwrapped model output of the next frames
+        :return: The note events that are complete, like the note events of model_output_to_notes
+        """
+        if self.buffer is None:
+            self.buffer = {k: v for k, v in activations.items()}
+        else:
+            self.buffer = {k: np.concatenate([self.buffer[k], activations[k]]) for k in self.buffer}
+        return self._extract(final=False)
+
+    def finish(self) -> list:
+        """
+        End the stream
+        :return: The remaining note events
+        """
+        if self.buffer is None:
+            return []
+        return self._extract(final=True)
+
+    def _extract(self, final: bool) -> list:
+        frames = self.buffer['note'].copy()
+        onsets = self.buffer['onset'].copy()
+        end = self.start + len(frames)
+        # The energy of emitted notes is removed, like output_to_notes_polyphonic does for the notes it found, so
+        # they are not extracted again
+        for note_start, note_end, pitch in self.emitted:
+            freq_idx = pitch - MIDI_OFFSET
+            frames[max(note_start - self.start, 0):note_end - self.start, max(freq_idx - 1, 0):freq_idx + 2] = 0
+        # The inferred onsets are undefined for silent buffers, which can't contain notes anyway
+        with np.errstate(divide='ignore', invalid='ignore'):
+            notes = output_to_notes_polyphonic(
+                frames, onsets,
+                onset_thresh=self.onset_threshold,
+                frame_thresh=self.frame_threshold,
+                min_note_len=self.minimum_note_length,
+                infer_onsets=True,
+                max_freq=1000,
+                min_freq=80,
+            )
+        notes = [note for note in notes if self.start + note[0] >= self.committed]
+
+        if final:
+            commit = end
+        else:
+            # Notes ending close to the end of the buffer may continue in the next activations
+            commit = end - self.margin
+            for note_start, note_end, _, _ in notes:
+                if self.start + note_end > end - self.margin:
+                    commit = min(commit, self.start + note_start)
+            commit = max(commit, end - self.max_buffer)
+        notes = sorted(note for note in notes if self.start + note[0] < commit)
+
+        note_events = []
+        for note_start, note_end, pitch, _, bends in get_pitch_bends(self.buffer['contour'], notes):
+            # The amplitude is computed without the removed energy, like in the whole song
+            amplitude = np.mean(self.buffer['note'][note_start:note_end, pitch - MIDI_OFFSET])
+            start_time, end_time = frame_times(np.array([self.start + note_start, self.start + note_end]))
+            note_events.append((start_time, end_time, pitch, amplitude, bends))
+            self.emitted.append((self.start + note_start, self.start + note_end, pitch))
+
+        self.committed = max(self.committed, commit)
+        new_start = max(self.start, min(self.committed - self.context, end))
+        self.buffer = {k: v[new_start - self.start:] for k, v in self.buffer.items()}
+        self.start = new_start
+        self.emitted = [note for note in self.emitted if note[1] > self.start]
+        return note_events
+
+
+def stream_notes(
+        blocks,
+        basic_pitch_onset_threshold: float = 0.5,
+        basic_pitch_frame_threshold: float = 0.3,
+        basic_pitch_minimum_note_length: float = 127.7,
+        batch_size: int = WINDOW_BATCH_SIZE,
+):
+    """
+    Transcribe audio blocks, emitting the notes as soon as they are complete
+    :param blocks: The audio blocks at the Basic Pitch sample rate
+    :param batch_size: The number of windows per batch
+    :return: A generator yielding the note events in the order of their start
+    """
+    note_stream = NoteStream(basic_pitch_onset_threshold, basic_pitch_frame_threshold, basic_pitch_minimum_note_length)
+    for activations in stream_activations(blocks, batch_size):
+        yield from note_stream.add(activations)
+    yield from note_stream.finish()
+
+
+def transcribe_vocals_stream(
+        vocals_path: str,
+        noise_gate_threshold: float = -18.0,
+        noise_gate_attack: float = 500.0,
+        noise_gate_release: float = 1500.0,
+        lowpass_cutoff: float = 500.0,
+        compressor_threshold: float = -6.0,
+        compressor_ratio: float = 5.0,
+        compressor_attack: float = 1.0,
+        compressor_release: float = 100.0,
+        basic_pitch_onset_threshold: float = 0.5,
+        basic_pitch_frame_threshold: float = 0.3,
+        basic_pitch_minimum_note_length: float = 127.7,
+        normalization: str = 'two_pass',
+        block_seconds: float = BLOCK_SECONDS,
+):
+    """
+    Transcribe a vocals file like transcription.transcribe_vocals without an ML model, but reading, conditioning and
+    transcribing the audio in blocks. The memory needed doesn't depend on the length of the file, so it can be used
+    for live sets or medleys of any length, and the first notes are available long before the whole file is processed.
+    :param vocals_path: The path of the audio file, in a format supported by libsndfile
+    :param normalization: "two_pass" or "running", see condition_blocks
+    :param block_seconds: The length of the blocks the file is read in
+    :return: A generator yielding the note events (start time, end time, pitch, amplitude, pitch bends) in the order
+    of their start. basic_pitch.note_creation.note_events_to_midi converts them to a PrettyMIDI object.
+    """
+    blocks = condition_blocks(
+        vocals_path,
+        noise_gate_threshold, noise_gate_attack, noise_gate_release,
+        lowpass_cutoff,
+        compressor_threshold, compressor_ratio, compressor_attack, compressor_release,
+        normalization, block_seconds,
+    )
+    yield from stream_notes(
+        blocks, basic_pitch_onset_threshold, basic_pitch_frame_threshold, basic_pitch_minimum_note_length,
+    )
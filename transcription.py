@@ -1,30 +1,60 @@
-import os
-
-import tensorflow as tf
-import torch
-import torchaudio
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict
+import librosa
+import numpy as np
+from basic_pitch.constants import ANNOTATIONS_FPS, AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+from basic_pitch.note_creation import model_output_to_notes
 from pedalboard import Pedalboard, NoiseGate, LowpassFilter, Compressor
-from pedalboard.io import AudioFile
-from pydub import AudioSegment, effects
-from speechbrain.pretrained import SpectralMaskEnhancement, WaveformEnhancement
-
-# Load models in advance to cache them between function calls
-basic_pitch_model = tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))
-metricgan_model = SpectralMaskEnhancement.from_hparams(
-    source="speechbrain/metricgan-plus-voicebank",
-    savedir="models/metricgan-plus-voicebank",
-)
-mtl_model = WaveformEnhancement.from_hparams(
-    source="speechbrain/mtl-mimic-voicebank",
-    savedir="models/mtl-mimic-voicebank",
-)
+
+from activation_cache import ActivationCache, hash_audio
+from instrumentation import count, stage
+from models import models
+
+# Sample rate of the speech enhancement models
+ENHANCEMENT_SAMPLE_RATE = 16000
+# Length of the chunks the enhancement models process, so the memory needed doesn't grow with the length of the song.
+# None enhances the whole song at once.
+ENHANCEMENT_CHUNK_SECONDS = 8.0
+# Length of the crossfade between two consecutive chunks
+ENHANCEMENT_OVERLAP_SECONDS = 0.5
+# Number of chunks enhanced in a single forward pass
+ENHANCEMENT_BATCH_SIZE = 8
+
+# Windowing used by basic_pitch.inference.run_inference
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+# Number of windows of all songs that are passed to the Basic Pitch model at once by run_inference_batch
+INFERENCE_BATCH_SIZE = 64
+# Parameters of transcribe_vocals that are passed to the note extraction instead of the conditioning
+NOTE_PARAMS = ('basic_pitch_onset_threshold', 'basic_pitch_frame_threshold', 'basic_pitch_minimum_note_length')
+
+
+def working_sample_rate(ml_model: str = None) -> int:
+    """
+    Get the sample rate the vocals should be decoded at, so they only have to be resampled once.
+    Without an ML model, the whole pipeline runs at the Basic Pitch sample rate. Otherwise, the audio is processed at
+    the sample rate of the enhancement model and resampled to the Basic Pitch sample rate after enhancement.
+    :param ml_model: The ML model used for enhancement
+    :return: The sample rate in Hz
+    """
+    return ENHANCEMENT_SAMPLE_RATE if ml_model else AUDIO_SAMPLE_RATE
+
+
+def load_vocals(vocals_path: str, sample_rate: int = AUDIO_SAMPLE_RATE) -> np.ndarray:
+    """
+    Decode an audio file to a mono float32 buffer
+    :param vocals_path: The path of the audio file
+    :param sample_rate: The sample rate to resample the audio to
+    :return: The audio samples
+    """
+    with stage('decode'):
+        audio, _ = librosa.load(vocals_path, sr=sample_rate, mono=True)
+    count('samples_decoded', len(audio))
+    return audio
 
 
 def transcribe_vocals(
         vocals_path: str,
-        workdir: str,
+        workdir: str = None,
         noise_gate_threshold: float = -18.0,
         noise_gate_attack: float = 500.0,
         noise_gate_release: float = 1500.0,
@@ -37,71 +67,426 @@ def transcribe_vocals(
         basic_pitch_onset_threshold: float = 0.5,
         basic_pitch_frame_threshold: float = 0.3,
         basic_pitch_minimum_note_length: float = 127.7,
+        activation_cache: ActivationCache = None,
+        audio: np.ndarray = None,
+        enhancement_batch_size: int = None,
+        enhancement_threads: int = None,
 ):
-    def normalize_audio(in_path: str, out_path: str):
-        audio = AudioSegment.from_file(in_path)
-        normalized = effects.normalize(audio)
-        normalized.export(out_path, format="wav")
-
-    def apply_pedalboard(board, in_path, out_path):
-        with AudioFile(in_path) as audio:
-            with AudioFile(out_path, 'w', audio.samplerate, audio.num_channels) as output:
-                # Loop over file and apply pedalboard effects
-                while audio.tell() < audio.frames:
-                    chunk = audio.read(int(audio.samplerate))
-                    effected = board.process(chunk, audio.samplerate, reset=False)
-                    output.write(effected)
-
-    def apply_metricgan(in_path, out_path):
-        noisy = metricgan_model.load_audio(in_path).unsqueeze(0)
-        enhanced = metricgan_model.enhance_batch(noisy, lengths=torch.tensor([1.]))
-        torchaudio.save(out_path, enhanced.cpu(), 16000)
-
-    def apply_mtl(in_path, out_path):
-        enhanced = mtl_model.enhance_file(in_path)
-        torchaudio.save(out_path, enhanced.unsqueeze(0).cpu(), 16000)
-
-    def optimize_audio(in_path: str, out_path: str):
-        # Setup pedalboard
-        board = Pedalboard([
-            NoiseGate(threshold_db=noise_gate_threshold, attack_ms=noise_gate_attack, release_ms=noise_gate_release),
-            LowpassFilter(cutoff_frequency_hz=lowpass_cutoff),
-            Compressor(
-                threshold_db=compressor_threshold,
-                ratio=compressor_ratio,
-                attack_ms=compressor_attack,
-                release_ms=compressor_release,
-            ),
-        ])
-
-        if ml_model:
-            tmp_path = os.path.join(workdir, "vocals_tmp.wav")
-            apply_pedalboard(board, in_path, tmp_path)
-            if ml_model == "metricgan":
-                apply_metricgan(tmp_path, out_path)
-            elif ml_model == "mtl":
-                apply_mtl(tmp_path, out_path)
+    """
+    Transcribe a vocals file. See transcribe_vocals_array for the parameters.
+    The workdir is not used anymore, since no intermediate files are written. It is only kept for compatibility.
+    :param audio: The vocals already decoded at working_sample_rate(ml_model), e.g. a view into an AudioStore. If
+    given, the vocals file is not decoded.
+    """
+    sample_rate = working_sample_rate(ml_model)
+    if audio is None:
+        audio = load_vocals(vocals_path, sample_rate)
+    return transcribe_vocals_array(
+        audio, sample_rate,
+        noise_gate_threshold, noise_gate_attack, noise_gate_release,
+        lowpass_cutoff,
+        compressor_threshold, compressor_ratio, compressor_attack, compressor_release,
+        ml_model,
+        basic_pitch_onset_threshold, basic_pitch_frame_threshold, basic_pitch_minimum_note_length,
+        activation_cache=activation_cache,
+        enhancement_batch_size=enhancement_batch_size,
+        enhancement_threads=enhancement_threads,
+    )
+
+
+def transcribe_vocals_array(
+        audio: np.ndarray,
+        sample_rate: int,
+        noise_gate_threshold: float = -18.0,
+        noise_gate_attack: float = 500.0,
+        noise_gate_release: float = 1500.0,
+        lowpass_cutoff: float = 500.0,
+        compressor_threshold: float = -6.0,
+        compressor_ratio: float = 5.0,
+        compressor_attack: float = 1.0,
+        compressor_release: float = 100.0,
+        ml_model: str = None,
+        basic_pitch_onset_threshold: float = 0.5,
+        basic_pitch_frame_threshold: float = 0.3,
+        basic_pitch_minimum_note_length: float = 127.7,
+        activation_cache: ActivationCache = None,
+        enhancement_batch_size: int = None,
+        enhancement_threads: int = None,
+):
+    """
+    Transcribe vocals that are already decoded. The audio is passed through all stages in memory.
+    To avoid unnecessary resampling, the audio should be at working_sample_rate(ml_model).
+    :param audio: The mono float32 audio samples
+    :param sample_rate: The sample rate of the audio
+    :return: The transcribed PrettyMIDI notes
+    """
+    optimized = condition_audio(
+        audio, sample_rate,
+        noise_gate_threshold, noise_gate_attack, noise_gate_release,
+        lowpass_cutoff,
+        compressor_threshold, compressor_ratio, compressor_attack, compressor_release,
+        ml_model,
+        enhancement_batch_size=enhancement_batch_size,
+        enhancement_threads=enhancement_threads,
+    )
+    return to_notes(extract_notes(
+        infer_activations(optimized, activation_cache),
+        basic_pitch_onset_threshold, basic_pitch_frame_threshold, basic_pitch_minimum_note_length,
+    )[0])
+
+
+def transcribe_vocals_batch(songs: list[dict], activation_cache: ActivationCache = None) -> list:
+    """
+    Transcribe several vocals files, running the Basic Pitch model on the windows of all songs at once.
+    Every song is conditioned with its own parameters, so the songs can belong to different candidates.
+    :param songs: The keyword arguments of transcribe_vocals for every song, e.g. the vocals_path, the audio and the
+    parameters of the conditioning and the note extraction
+    :param activation_cache: The cache of the model outputs
+    :return: The transcribed PrettyMIDI notes of every song
+    """
+    conditioned = []
+    note_params = []
+    for song in songs:
+        params = dict(song)
+        vocals_path = params.pop('vocals_path')
+        audio = params.pop('audio', None)
+        note_params.append({name: params.pop(name) for name in NOTE_PARAMS if name in params})
+        sample_rate = working_sample_rate(params.get('ml_model'))
+        if audio is None:
+            audio = load_vocals(vocals_path, sample_rate)
+        conditioned.append(condition_audio(audio, sample_rate, **params))
+    model_outputs = infer_activations_batch(conditioned, activation_cache)
+    return [to_notes(extract_notes(model_output, **params)[0])
+            for model_output, params in zip(model_outputs, note_params)]
+
+
+def to_notes(midi_data) -> list:
+    # The notes of the transcribed vocals, which are the only instrument if any note was found
+    if len(midi_data.instruments) == 0:
+        return []
+    return midi_data.instruments[0].notes
+
+
+def resample(samples: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    if from_rate == to_rate:
+        return samples
+    return librosa.resample(samples, orig_sr=from_rate, target_sr=to_rate)
+
+
+def normalization_gain(peak: float) -> np.float32:
+    # Peak normalization with the same headroom as pydub.effects.normalize
+    if peak == 0:
+        return np.float32(1)
+    return np.float32(10 ** (-0.1 / 20) / peak)
+
+
+def normalize_audio(samples: np.ndarray) -> np.ndarray:
+    peak = np.max(np.abs(samples))
+    if peak == 0:
+        return samples
+    return samples * normalization_gain(peak)
+
+
+def apply_metricgan(samples: np.ndarray) -> np.ndarray:
+    import torch
+    noisy = torch.from_numpy(samples).unsqueeze(0)
+    enhanced = models.get('metricgan').enhance_batch(noisy, lengths=torch.tensor([1.]))
+    return enhanced.squeeze(0).cpu().numpy()
+
+
+def apply_mtl(samples: np.ndarray) -> np.ndarray:
+    import torch
+    noisy = torch.from_numpy(samples).unsqueeze(0)
+    enhanced = models.get('mtl').enhance_batch(noisy)
+    return enhanced.squeeze(0).cpu().numpy()
+
+
+def enhance_batch(noisy, ml_model: str):
+    """
+    Enhance a batch of audio of the same length
+    :param noisy: The audio as tensor with shape (batch, samples) at the enhancement sample rate
+    :param ml_model: The enhancement model, "metricgan" or "mtl"
+    :return: The enhanced audio as tensor with shape (batch, samples)
+    """
+    import torch
+    if ml_model == "metricgan":
+        return models.get('metricgan').enhance_batch(noisy, lengths=torch.ones(noisy.shape[0]))
+    if ml_model == "mtl":
+        return models.get('mtl').enhance_batch(noisy)
+    raise ValueError(f"Unknown ML model: {ml_model}")
+
+
+def enhance_chunked(
+        samples: np.ndarray,
+        ml_model: str,
+        chunk_seconds: float = None,
+        overlap_seconds: float = None,
+        batch_size: int = None,
+        threads: int = None,
+        out: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Enhance the audio in overlapping chunks of a fixed length, which are enhanced in batches and joined with a linear
+    crossfade. The memory needed only depends on the chunk length and the batch size, not on the length of the song.
+    :param samples: The audio at the enhancement sample rate
+    :param ml_model: The enhancement model, "metricgan" or "mtl"
+    :param chunk_seconds: The length of the chunks. Uses ENHANCEMENT_CHUNK_SECONDS if None.
+    :param overlap_seconds: The length of the crossfade. Uses ENHANCEMENT_OVERLAP_SECONDS if None.
+    :param batch_size: The number of chunks per forward pass. Uses ENHANCEMENT_BATCH_SIZE if None.
+    :param threads: The number of torch threads. If None, the current setting is kept.
+    :param out: The array the enhanced audio is written to as soon as a batch is enhanced, e.g. a np.memmap. A new
+    array is created if None.
+    :return: The enhanced audio
+    """
+    import torch
+    if threads is not None:
+        torch.set_num_threads(threads)
+    chunk_length = int((chunk_seconds or ENHANCEMENT_CHUNK_SECONDS) * ENHANCEMENT_SAMPLE_RATE)
+    overlap_length = int((overlap_seconds or ENHANCEMENT_OVERLAP_SECONDS) * ENHANCEMENT_SAMPLE_RATE)
+    batch_size = batch_size or ENHANCEMENT_BATCH_SIZE
+    hop_length = chunk_length - overlap_length
+    # Every chunk but the first starts within the song and ends after the overlap with the previous chunk
+    n_chunks = max(1, int(np.ceil((len(samples) - overlap_length) / hop_length)))
+    # The fades of two overlapping chunks add up to one, so the chunks can be added to the output directly
+    fade_in = (np.arange(overlap_length, dtype=np.float32) + 0.5) / overlap_length
+
+    if out is None:
+        out = np.zeros(len(samples), dtype=np.float32)
+    else:
+        out[:] = 0
+    for batch_start in range(0, n_chunks, batch_size):
+        chunk_indices = range(batch_start, min(batch_start + batch_size, n_chunks))
+        noisy = np.zeros((len(chunk_indices), chunk_length), dtype=np.float32)
+        for row, chunk_index in enumerate(chunk_indices):
+            chunk = samples[chunk_index * hop_length:chunk_index * hop_length + chunk_length]
+            noisy[row, :len(chunk)] = chunk
+        with torch.no_grad():
+            enhanced = enhance_batch(torch.from_numpy(noisy), ml_model).cpu().numpy()
+
+        for row, chunk_index in enumerate(chunk_indices):
+            start = chunk_index * hop_length
+            chunk = enhanced[row, :min(chunk_length, len(samples) - start)].copy()
+            if chunk_index > 0:
+                chunk[:overlap_length] *= fade_in
+            if chunk_index < n_chunks - 1:
+                chunk[-overlap_length:] *= 1 - fade_in
+            out[start:start + len(chunk)] += chunk
+    return out
+
+
+def create_board(
+        noise_gate_threshold: float = -18.0,
+        noise_gate_attack: float = 500.0,
+        noise_gate_release: float = 1500.0,
+        lowpass_cutoff: float = 500.0,
+        compressor_threshold: float = -6.0,
+        compressor_ratio: float = 5.0,
+        compressor_attack: float = 1.0,
+        compressor_release: float = 100.0,
+) -> Pedalboard:
+    return Pedalboard([
+        NoiseGate(threshold_db=noise_gate_threshold, attack_ms=noise_gate_attack, release_ms=noise_gate_release),
+        LowpassFilter(cutoff_frequency_hz=lowpass_cutoff),
+        Compressor(
+            threshold_db=compressor_threshold,
+            ratio=compressor_ratio,
+            attack_ms=compressor_attack,
+            release_ms=compressor_release,
+        ),
+    ])
+
+
+def condition_audio(
+        audio: np.ndarray,
+        sample_rate: int,
+        noise_gate_threshold: float = -18.0,
+        noise_gate_attack: float = 500.0,
+        noise_gate_release: float = 1500.0,
+        lowpass_cutoff: float = 500.0,
+        compressor_threshold: float = -6.0,
+        compressor_ratio: float = 5.0,
+        compressor_attack: float = 1.0,
+        compressor_release: float = 100.0,
+        ml_model: str = None,
+        enhancement_batch_size: int = None,
+        enhancement_threads: int = None,
+) -> np.ndarray:
+    """
+    Normalize the vocals and optimize them for the transcription with pedalboard and optionally an enhancement model
+    :param audio: The mono float32 audio samples
+    :param sample_rate: The sample rate of the audio
+    :param enhancement_batch_size: The number of chunks enhanced per forward pass. Uses ENHANCEMENT_BATCH_SIZE if None.
+    :param enhancement_threads: The number of torch threads of the enhancement. If None, the current setting is kept.
+    :return: The optimized audio at the Basic Pitch sample rate
+    """
+    with stage('normalize'):
+        samples = normalize_audio(audio.astype(np.float32, copy=False))
+    board = create_board(
+        noise_gate_threshold, noise_gate_attack, noise_gate_release,
+        lowpass_cutoff,
+        compressor_threshold, compressor_ratio, compressor_attack, compressor_release,
+    )
+
+    if ml_model:
+        with stage('resample'):
+            samples = resample(samples, sample_rate, ENHANCEMENT_SAMPLE_RATE)
+        with stage('pedalboard'):
+            samples = board.process(samples, ENHANCEMENT_SAMPLE_RATE)
+        if ml_model not in ("metricgan", "mtl"):
+            raise ValueError(f"Unknown ML model: {ml_model}")
+        with stage(ml_model):
+            if ENHANCEMENT_CHUNK_SECONDS is not None:
+                samples = enhance_chunked(samples, ml_model, batch_size=enhancement_batch_size,
+                                          threads=enhancement_threads)
             else:
-                raise ValueError(f"Unknown ML model: {ml_model}")
-        else:
-            apply_pedalboard(board, in_path, out_path)
-
-    def predict_notes(in_path: str):
-        model_output, midi_data, note_events = predict(
-            in_path,
-            basic_pitch_model,
-            minimum_frequency=80,
-            maximum_frequency=1000,
-            onset_threshold=basic_pitch_onset_threshold,
-            frame_threshold=basic_pitch_frame_threshold,
-            minimum_note_length=basic_pitch_minimum_note_length,
+                if enhancement_threads is not None:
+                    import torch
+                    torch.set_num_threads(enhancement_threads)
+                samples = apply_metricgan(samples) if ml_model == "metricgan" else apply_mtl(samples)
+        with stage('resample'):
+            return resample(samples, ENHANCEMENT_SAMPLE_RATE, AUDIO_SAMPLE_RATE)
+    with stage('pedalboard'):
+        samples = board.process(samples, sample_rate)
+    with stage('resample'):
+        return resample(samples, sample_rate, AUDIO_SAMPLE_RATE)
+
+
+def run_inference(samples: np.ndarray) -> dict:
+    """
+    Same as basic_pitch.inference.run_inference, but on the samples instead of an audio file
+    :param samples: The audio at the Basic Pitch sample rate
+    :return: The unwrapped model output
+    """
+    return run_inference_batch([samples])[0]
+
+
+def window_audio(samples: np.ndarray) -> np.ndarray:
+    """
+    Split the audio into the overlapping windows the Basic Pitch model is applied to, like
+    basic_pitch.inference.run_inference does
+    :param samples: The audio at the Basic Pitch sample rate
+    :return: The windows with shape (n_windows, AUDIO_N_SAMPLES, 1)
+    """
+    # basic_pitch.inference imports TF, so it is only imported once inference is needed
+    from basic_pitch.inference import window_audio_file
+    samples = np.concatenate([np.zeros((OVERLAP_LEN // 2,), dtype=np.float32), samples])
+    audio_windowed, _ = window_audio_file(samples, HOP_SIZE)
+    return audio_windowed.numpy()
+
+
+def unwrap_windows(raw_output: np.ndarray, original_length: int) -> np.ndarray:
+    """
+    Same as basic_pitch.inference.unwrap_output, but on the model output of a single song as array
+    :param raw_output: The model output of the windows of the song, shape (n_windows, n_frames, n_freqs)
+    :param original_length: The number of samples of the song
+    :return: The model output with shape (n_frames, n_freqs)
+    """
+    n_olap = N_OVERLAPPING_FRAMES // 2
+    raw_output = raw_output[:, n_olap:-n_olap, :]
+    n_output_frames_original = int(np.floor(original_length * (ANNOTATIONS_FPS / AUDIO_SAMPLE_RATE)))
+    unwrapped_output = raw_output.reshape(raw_output.shape[0] * raw_output.shape[1], raw_output.shape[2])
+    return unwrapped_output[:n_output_frames_original, :]
+
+
+def run_windows(windows: np.ndarray, batch_size: int = INFERENCE_BATCH_SIZE) -> dict:
+    """
+    Run the Basic Pitch model on windows in batches of a fixed size
+    :param windows: The windows with shape (n_windows, AUDIO_N_SAMPLES, 1)
+    :param batch_size: The number of windows per batch. The last batch may be smaller, the model accepts any number of
+    windows.
+    :return: The raw model output of the windows, with shape (n_windows, n_frames, n_freqs)
+    """
+    model = models.get('basic_pitch')
+    outputs = {}
+    for start in range(0, len(windows), batch_size):
+        output = model(windows[start:start + batch_size])
+        for k in output:
+            outputs.setdefault(k, []).append(output[k].numpy())
+    return {k: np.concatenate(v) for k, v in outputs.items()}
+
+
+def run_inference_batch(samples_list: list[np.ndarray], batch_size: int = INFERENCE_BATCH_SIZE) -> list[dict]:
+    """
+    Run the Basic Pitch model on several songs at once.
+    The windows of all songs are packed into batches of a fixed size, so the model always processes large batches
+    instead of one small batch per song. The model processes every window on its own, so the output of every song
+    doesn't depend on the other songs of the batch.
+    :param samples_list: The audio of every song at the Basic Pitch sample rate
+    :param batch_size: The number of windows per batch
+    :return: The unwrapped model output of every song
+    """
+    if not samples_list:
+        return []
+    windows = [window_audio(samples) for samples in samples_list]
+    window_counts = [len(song_windows) for song_windows in windows]
+    outputs = run_windows(np.concatenate(windows), batch_size)
+
+    # Split the windows up into the songs again
+    results = []
+    offsets = np.concatenate([[0], np.cumsum(window_counts)])
+    for i, samples in enumerate(samples_list):
+        results.append({
+            k: unwrap_windows(v[offsets[i]:offsets[i + 1]], samples.shape[0]) for k, v in outputs.items()
+        })
+    return results
+
+
+def infer_activations(samples: np.ndarray, activation_cache: ActivationCache = None) -> dict:
+    # The model output only depends on the optimized audio, so it can be reused for all trials
+    # that only change the note extraction thresholds
+    return infer_activations_batch([samples], activation_cache)[0]
+
+
+def infer_activations_batch(samples_list: list[np.ndarray], activation_cache: ActivationCache = None) -> list[dict]:
+    """
+    Same as infer_activations for several songs, running the model on all songs that are not cached in one batch
+    :param samples_list: The audio of every song at the Basic Pitch sample rate
+    :param activation_cache: The cache of the model outputs
+    :return: The model output of every song
+    """
+    model_outputs = [None] * len(samples_list)
+    if activation_cache is not None:
+        with stage('activation_cache'):
+            cache_keys = [hash_audio(samples) for samples in samples_list]
+            model_outputs = [activation_cache.get(cache_key) for cache_key in cache_keys]
+    missing = [i for i, model_output in enumerate(model_outputs) if model_output is None]
+    if activation_cache is not None:
+        count('activation_cache_hits', len(samples_list) - len(missing))
+        count('activation_cache_misses', len(missing))
+    if not missing:
+        return model_outputs
+    with stage('basic_pitch'):
+        inferred = run_inference_batch([samples_list[i] for i in missing])
+    for i, model_output in zip(missing, inferred):
+        count('frames_inferred', len(model_output['note']))
+        model_outputs[i] = model_output
+        if activation_cache is not None:
+            with stage('activation_cache'):
+                activation_cache.put(cache_keys[i], model_output)
+    return model_outputs
+
+
+def extract_notes(
+        model_output: dict,
+        basic_pitch_onset_threshold: float = 0.5,
+        basic_pitch_frame_threshold: float = 0.3,
+        basic_pitch_minimum_note_length: float = 127.7,
+):
+    """
+    Same note extraction as basic_pitch.inference.predict, but with the model output split out for caching
+    :param model_output: The unwrapped model output
+    :return: The PrettyMIDI object and the note events
+    """
+    with stage('note_extraction'):
+        midi_data, note_events = model_output_to_notes(
+            model_output,
+            onset_thresh=basic_pitch_onset_threshold,
+            frame_thresh=basic_pitch_frame_threshold,
+            # Convert milliseconds to frames
+            min_note_len=int(np.round(basic_pitch_minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP))),
+            min_freq=80,
+            max_freq=1000,
         )
-        if len(midi_data.instruments) == 0:
-            return []
-        return midi_data.instruments[0].notes
-
-    norm_vocals = os.path.join(workdir, "vocals_normalized.wav")
-    normalize_audio(vocals_path, norm_vocals)
-    opt_vocals = os.path.join(workdir, "vocals_optimized.wav")
-    optimize_audio(norm_vocals, opt_vocals)
-    return predict_notes(opt_vocals)
+    count('note_frames', len(model_output['note']))
+    count('notes_emitted', len(note_events))
+    return midi_data, note_events
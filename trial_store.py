@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+from skopt.space import Dimension
+
+
+class TrialStore:
+    """
+    Append-only JSON lines store for the trials of optimization runs.
+    Every evaluated parameter set is written (and flushed to disk) as soon as it has been scored, so a crashed run
+    loses at most the trials that were still being evaluated.
+    Each line contains the name of the run, the parameters by name, the score, the per-song scores and the timing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb+') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    # Terminate a line left incomplete by a crash, so new trials start on their own line
+                    file.write(b'\n')
+
+    def append(self, run: str, params: dict, score: float, songs: list, seconds: float):
+        """
+        Persist an evaluated trial
+        :param run: The name of the optimization run
+        :param params: The evaluated parameters by name
+        :param score: The aggregated score of the trial
+        :param songs: The per-song results, each a dict containing the song name, score and duration
+        :param seconds: The wall time needed to evaluate the trial
+        """
+        row = {
+            'run': run,
+            'time': time.time(),
+            'params': params,
+            'score': score,
+            'seconds': seconds,
+            'songs': songs,
+        }
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(row) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def load(self, runs: list = None) -> list:
+        """
+        Load the stored trials
+        :param runs: The names of the runs to load the trials of. If None, the trials of all runs are loaded.
+        :return: The trials in the order they were stored
+        """
+        return read_rows(self.path, runs)
+
+
+def read_rows(path: str, runs: list = None) -> list:
+    """
+    Read the rows of a JSON lines file written by several runs, e.g. the trials or the profiles of the trials
+    :param path: The path of the file
+    :param runs: The names of the runs to read the rows of. If None, the rows of all runs are read.
+    :return: The rows in the order they were written, or an empty list if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        return []
+    rows = []
+    with open(path) as file:
+        for line in file:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be incomplete if the process crashed while writing it
+                continue
+            if runs is None or row.get('run') in runs:
+                rows.append(row)
+    return rows
+
+
+def to_points(rows: list, dimensions: list[Dimension]) -> tuple[list, list]:
+    """
+    Convert stored trials to points of the given search space, e.g. to pass them to gp_minimize as x0 and y0.
+    Since the parameters are stored by name, trials of runs with other bounds can be used as well. Trials that are
+    missing a parameter or lie outside of the current bounds are skipped.
+    :param rows: The stored trials
+    :param dimensions: The named dimensions of the search space
+    :return: The points and their scores
+    """
+    x = []
+    y = []
+    for row in rows:
+        params = row['params']
+        if any(dimension.name not in params for dimension in dimensions):
+            continue
+        point = [params[dimension.name] for dimension in dimensions]
+        if all(value in dimension for value, dimension in zip(point, dimensions)):
+            x.append(point)
+            y.append(row['score'])
+    return x, y
@@ -0,0 +1,72 @@
+import io
+
+import librosa
+import numpy as np
+import soundfile
+
+# Sample rate of the audio stored in the dataset. 16 kHz is the sample rate of the MT3 SPECTROGRAM_CONFIG, so MT3
+# doesn't have to resample the audio when reading it. None keeps the original sample rate and channels.
+sample_rate = 16000
+# Container of the audio stored in the dataset, 'wav' or 'flac'. Both store the samples as 16 bit integers.
+audio_format = 'wav'
+
+
+def load_audio(path: str) -> tuple[np.ndarray, int]:
+    """
+    Load an audio file in the target format of the dataset
+    :param path: The path of the audio file
+    :return: The samples, downmixed to mono and resampled to the target sample rate if one is configured, otherwise with
+    shape (channels, samples) at the original sample rate, and the sample rate
+    """
+    return librosa.load(path, sr=sample_rate, mono=sample_rate is not None)
+
+
+def encode_audio(samples: np.ndarray, samples_sample_rate: int, container: str = None) -> bytes:
+    """
+    Encode samples as 16 bit WAVE or FLAC file in memory
+    :param samples: The samples, either with shape (samples,) or (channels, samples)
+    :param samples_sample_rate: The sample rate of the samples
+    :param container: The container, 'wav' or 'flac'. Uses audio_format if None.
+    :return: The content of the encoded file
+    """
+    buffer = io.BytesIO()
+    soundfile.write(buffer, samples.T, samples_sample_rate, format=(container or audio_format).upper(),
+                    subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def convert_audio(path: str) -> bytes:
+    """
+    Convert an audio file to the target format of the dataset
+    :param path: The path of the audio file, e.g. an MP3 file
+    :return: The content of the converted file
+    """
+    return encode_audio(*load_audio(path))
+
+
+def transcode_audio(data: bytes) -> bytes:
+    """
+    Store the samples of an in-memory WAVE file in the configured container without changing them
+    :param data: The content of the WAVE file
+    :return: The content of the file in the configured container
+    """
+    if audio_format == 'wav':
+        return data
+    samples, samples_sample_rate = soundfile.read(io.BytesIO(data), dtype='int16', always_2d=True)
+    return encode_audio(samples.T, samples_sample_rate)
+
+
+def decode_audio(data: bytes, target_sample_rate: int = None) -> tuple[np.ndarray, int]:
+    """
+    Decode the audio of a dataset example, which may be stored in any of the supported formats
+    :param data: The content of the WAVE or FLAC file
+    :param target_sample_rate: The sample rate to resample the audio to, if it isn't stored at this sample rate yet.
+    If None, the audio is returned at the stored sample rate.
+    :return: The mono samples as float32 and their sample rate
+    """
+    samples, samples_sample_rate = soundfile.read(io.BytesIO(data), dtype='float32', always_2d=True)
+    samples = samples.mean(axis=1, dtype=np.float32)
+    if target_sample_rate is not None and samples_sample_rate != target_sample_rate:
+        samples = librosa.resample(samples, orig_sr=samples_sample_rate, target_sr=target_sample_rate)
+        samples_sample_rate = target_sample_rate
+    return samples, samples_sample_rate
@@ -0,0 +1,181 @@
+import os
+from multiprocessing import get_context
+from typing import Literal
+
+import numpy as np
+import note_seq
+import tensorflow as tf
+from mido import bpm2tempo
+from sklearn.model_selection import train_test_split
+
+from usdx_dataset.audio_format import convert_audio
+from usdx_dataset.create_usdx_dataset import (
+    RECORD_OVERHEAD, compression, create_index_entry, dataset_dir, get_shard_file_name, remove_shards,
+    serialize_example, shard_target_bytes, write_record_index, write_shard_manifest
+)
+from usdx_dataset.prepare_data import get_files
+from usdx_dataset.usdx_tools import SongData, parse_song
+
+input_dir = 'data/usdx/'
+# Number of worker processes converting songs in parallel (None uses all cores)
+workers = None
+# Resolution of the note timing, identical to the MIDI files written by usdx_tools.song_to_midi
+ticks_per_beat = 4
+
+
+def song_to_note_sequence(song: SongData) -> note_seq.NoteSequence:
+    """
+    Convert parsed USDX song data directly to a NoteSequence.
+    The result is the same as writing the song to a MIDI file with usdx_tools.song_to_midi and reading it with
+    note_seq.midi_file_to_sequence_proto: the notes use the same ticks and tempo and their times are calculated the
+    same way PrettyMIDI calculates them. Like PrettyMIDI, notes without length are left out.
+    :param song: The song data
+    :return: The NoteSequence of the song
+    """
+    if song.start_offset is None:
+        raise ValueError('Song has no GAP')
+    tempo = bpm2tempo(song.bpm)
+    # Seconds per tick as calculated by PrettyMIDI
+    tick_scale = 60.0 / ((6e7 / tempo) * ticks_per_beat)
+
+    start_ticks = song.starts + song.start_offset
+    end_ticks = start_ticks + song.lengths
+    # Same sanity check as song_to_midi, notes must not start before the previous note ended
+    previous_ends = np.concatenate([[0], end_ticks[:-1]])
+    invalid = np.flatnonzero(start_ticks < previous_ends)
+    if len(invalid) > 0:
+        i = invalid[0]
+        raise Exception(f'Invalid midi note time: {start_ticks[i] - previous_ends[i]} '
+                        f'(start time: {song.starts[i]}, current position: {previous_ends[i] - song.start_offset})')
+
+    sequence = note_seq.NoteSequence()
+    sequence.ticks_per_quarter = ticks_per_beat
+    sequence.source_info.parser = note_seq.NoteSequence.SourceInfo.PRETTY_MIDI
+    sequence.source_info.encoding_type = note_seq.NoteSequence.SourceInfo.MIDI
+    sequence_tempo = sequence.tempos.add()
+    sequence_tempo.time = 0.0
+    sequence_tempo.qpm = 60.0 / (tick_scale * ticks_per_beat)
+
+    for start, end, pitch in zip(start_ticks.tolist(), end_ticks.tolist(), song.pitches.tolist()):
+        if end == start:
+            continue
+        note = sequence.notes.add()
+        note.instrument = 0
+        note.program = 1
+        note.start_time = start * tick_scale
+        note.end_time = end * tick_scale
+        note.pitch = 60 + pitch
+        note.velocity = 127
+        sequence.total_time = max(sequence.total_time, note.end_time)
+    return sequence
+
+
+def build_example(song: tuple[str, str, str]) -> tuple[str, str | None, bytes | None, str]:
+    """
+    Convert a single USDX song to a serialized example
+    :param song: The directory of the song, the name of its MP3 file and the name of its USDX .txt file
+    :return: The directory of the song, the id and serialized example and the rejection reason. If the song is not
+    suitable for training, the id and example are None.
+    """
+    root, mp3_file, usdx_file = song
+    try:
+        song_data = parse_song(os.path.join(root, usdx_file))
+        if not song_data.valid:
+            return root, None, None, song_data.reason
+        sequence = song_to_note_sequence(song_data)
+        audio = convert_audio(os.path.join(root, mp3_file))
+    except Exception as e:
+        print(f'Converting {root} failed: {e}')
+        return root, None, None, 'FAILED'
+    # Same ids as the examples created from the prepared files
+    name = os.path.basename(usdx_file)[:-4]
+    entry_id = f'{name}.wav:{name}.mid'
+    return root, entry_id, serialize_example(entry_id.encode('utf-8'), audio, sequence.SerializeToString()), ''
+
+
+def build_dataset(songs: list[tuple[str, str, str]], dataset_type: Literal['train', 'test'], pool) -> dict:
+    """
+    Convert the songs in parallel and write the examples to the shards of a dataset as soon as they are ready
+    :param songs: The directory, MP3 file name and USDX file name of every song
+    :param dataset_type: The type of the dataset
+    :param pool: The worker pool converting the songs
+    :return: The number of skipped songs by rejection reason
+    """
+    output_dir = os.path.join(dataset_dir, dataset_type)
+    os.makedirs(output_dir, exist_ok=True)
+    remove_shards(dataset_type)
+
+    # The size of the examples is only known after converting the songs, so a new shard is started as soon as the
+    # current one reached the target size
+    shards = []
+    entries = []
+    writer = None
+    rejection_reasons = {}
+    for root, entry_id, example, reason in pool.imap(build_example, songs):
+        if example is None:
+            print(f'Song {root} is not suitable for training ({reason}), skipping')
+            rejection_reasons[reason] = rejection_reasons.get(reason, 0) + 1
+            continue
+        if writer is None or shards[-1]['bytes'] >= shard_target_bytes:
+            if writer is not None:
+                writer.close()
+            shards.append({'file': f'{dataset_type}.tfrecord-{len(shards):05d}.tmp', 'records': 0, 'bytes': 0})
+            offset = 0
+            writer = tf.io.TFRecordWriter(os.path.join(output_dir, shards[-1]['file']), options=compression)
+        writer.write(example)
+        # The entries refer to the index of their shard until the file names of the shards are known
+        entries.append(create_index_entry(entry_id, len(shards) - 1, offset, len(example)))
+        offset += len(example) + RECORD_OVERHEAD
+        shards[-1]['records'] += 1
+        shards[-1]['bytes'] += len(example)
+    if writer is not None:
+        writer.close()
+
+    # The number of shards is only known after all songs have been converted
+    for shard_index, shard in enumerate(shards):
+        shard_file_name = get_shard_file_name(dataset_type, shard_index, len(shards))
+        os.replace(os.path.join(output_dir, shard['file']), os.path.join(output_dir, shard_file_name))
+        shard['file'] = shard_file_name
+        shard['bytes'] = os.path.getsize(os.path.join(output_dir, shard_file_name))
+    for entry in entries:
+        entry['shard'] = shards[entry['shard']]['file']
+    write_shard_manifest(dataset_type, shards)
+    write_record_index(dataset_type, entries)
+    records = sum(shard['records'] for shard in shards)
+    print(f'Wrote {records} {dataset_type} songs to {len(shards)} shards')
+    return rejection_reasons
+
+
+def build_datasets(input_dir: str):
+    """
+    Build the train and test datasets directly from the USDX songs, without writing MIDI and WAVE files first
+    :param input_dir: The directory containing a subdirectory with an MP3 and a USDX .txt file for every song
+    """
+    songs = []
+    for root, _, files in os.walk(input_dir, onerror=print):
+        # Skip top directory
+        if root == input_dir:
+            continue
+        mp3_file, usdx_file = get_files(files)
+        if mp3_file is None:
+            print(f'MP3/USDX file missing in {root}, skipping')
+            continue
+        songs.append((root, mp3_file, usdx_file))
+    songs.sort()
+
+    train_songs, test_songs = train_test_split(songs, test_size=0.25, random_state=42)
+    print(f'Building datasets with {len(train_songs)} training songs and {len(test_songs)} test songs')
+
+    rejection_reasons = {}
+    # Spawn the workers, since forking a process that has imported TensorFlow is not safe
+    with get_context('spawn').Pool(workers) as pool:
+        for dataset_songs, dataset_type in ((train_songs, 'train'), (test_songs, 'test')):
+            for reason, count in build_dataset(dataset_songs, dataset_type, pool).items():
+                rejection_reasons[reason] = rejection_reasons.get(reason, 0) + count
+    print('Skipped songs:')
+    for reason, count in rejection_reasons.items():
+        print(f'{reason}: {count}')
+
+
+if __name__ == '__main__':
+    build_datasets(input_dir)
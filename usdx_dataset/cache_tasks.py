@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+# Directory of the seqio cache. The patched MT3 tasks read the cache from ./cache/, so this script has to be run from
+# the same working directory as the training.
+cache_dir = 'cache/'
+# Tasks of the USDX vocals dataset, see TASK_PREFIX in mt3/gin/vocals.gin
+tasks = [
+    'usdx_vocals_notes_ties_vb1_train',
+    'usdx_vocals_notes_ties_vb1_eval_train',
+    'usdx_vocals_notes_ties_vb1_validation',
+]
+# Number of local worker processes computing the spectrogram frames and targets (None uses all cores)
+workers = None
+
+
+def is_cached(task: str) -> bool:
+    # seqio marks the cache of a task as completed after all of its splits have been written
+    return os.path.exists(os.path.join(cache_dir, task, 'COMPLETED'))
+
+
+def cache_tasks(overwrite: bool = False):
+    """
+    Populate the local seqio cache of the USDX vocals tasks.
+    The cache contains the examples after all preprocessing steps up to the cache placeholder of the MT3 tasks, i.e.
+    the spectrogram frames of the audio and the tokenized targets. Training with cached tasks reads these examples
+    instead of decoding the audio and computing the frames on every epoch.
+    The cache is computed offline with Beam on the local machine, using several worker processes.
+    :param overwrite: Whether tasks that are already cached should be cached again
+    """
+    pending = tasks if overwrite else [task for task in tasks if not is_cached(task)]
+    if not pending:
+        print(f'All tasks are already cached in {cache_dir}')
+        return
+    print(f'Caching {len(pending)} of {len(tasks)} tasks in {cache_dir}')
+
+    pipeline_options = [
+        '--runner=DirectRunner',
+        '--direct_running_mode=multi_processing',
+        f'--direct_num_workers={workers or os.cpu_count()}',
+    ]
+    command = [
+        'seqio_cache_tasks',
+        f'--tasks={",".join(pending)}',
+        f'--output_cache_dir={cache_dir}',
+        '--module_import=mt3.tasks',
+        f'--pipeline_options={",".join(pipeline_options)}',
+        '--alsologtostderr',
+    ]
+    if overwrite:
+        command.append('--overwrite')
+    subprocess.run(command, check=True)
+
+    missing = [task for task in pending if not is_cached(task)]
+    if missing:
+        raise RuntimeError(f'Caching failed for tasks: {", ".join(missing)}')
+
+
+if __name__ == '__main__':
+    cache_tasks(overwrite='--overwrite' in sys.argv[1:])
@@ -1,12 +1,29 @@
+import glob
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from typing import Literal
 
+import numpy as np
 import tensorflow as tf
 import note_seq
 from sklearn.model_selection import train_test_split
 
+from usdx_dataset.audio_format import transcode_audio
+
 input_dir = 'data/prepared/'
 dataset_dir = 'data/datasets/usdx_vocals/'
+# Size the shards are split to, the actual shards are of about the same size
+shard_target_bytes = 150 * 1024 * 1024
+# Compression of the TFRecord files, None, 'GZIP' or 'ZLIB'. Readers have to use the same compression type.
+compression = None
+# Number of worker processes writing shards in parallel (None uses all cores)
+workers = None
+# Number of songs transcoded upfront to estimate the size of the audio in the configured container, e.g. FLAC
+size_sample_songs = 10
+# Bytes a TFRecord adds to every record: the length, the CRC of the length and the CRC of the data
+RECORD_OVERHEAD = 16
 
 
 def load_binary_file(file_path):
@@ -25,36 +42,172 @@ def serialize_example(id, audio, sequence):
     return example_proto.SerializeToString()
 
 
-def write_song_to_tfrecord(song: os.DirEntry, writer: tf.io.TFRecordWriter):
-    wav_file = f'{song.name}.wav'
-    midi_file = f'{song.name}.mid'
+def write_song_to_tfrecord(song_path: str, writer: tf.io.TFRecordWriter) -> tuple[str, int]:
+    song_name = os.path.basename(song_path)
+    wav_file = f'{song_name}.wav'
+    midi_file = f'{song_name}.mid'
     entry_id = f"{wav_file}:{midi_file}".encode('utf-8')
-    audio = load_binary_file(os.path.join(song.path, wav_file))
-    sequence = note_seq.midi_file_to_sequence_proto(os.path.join(song.path, midi_file)).SerializeToString()
+    # The prepared WAVE files already have the target sample rate, but may have to be stored in another container
+    audio = transcode_audio(load_binary_file(os.path.join(song_path, wav_file)))
+    sequence = note_seq.midi_file_to_sequence_proto(os.path.join(song_path, midi_file)).SerializeToString()
     example = serialize_example(entry_id, audio, sequence)
     writer.write(example)
+    return entry_id.decode('utf-8'), len(example)
 
 
-def generate_dataset(songs: [str], dataset_type: Literal['train', 'test']):
-    os.makedirs(os.path.join(dataset_dir, dataset_type), exist_ok=True)
+def get_shard_file_name(dataset_type: str, shard_index: int, num_shards: int) -> str:
+    return f'{dataset_type}.tfrecord-{shard_index:05d}-of-{num_shards:05d}'
+
 
-    shard_size = 3
-    num_shards = len(songs) // shard_size + 1
-    for shard_index in range(num_shards):
-        shard_file_name = f'{dataset_type}.tfrecord-{shard_index:05d}-of-{num_shards:05d}'
-        shard_file_path = os.path.join(dataset_dir, dataset_type, shard_file_name)
-        with (tf.io.TFRecordWriter(shard_file_path) as train_writer):
-            start_idx = shard_index * len(songs) // num_shards
-            end_idx = (shard_index + 1) * len(songs) // num_shards
+def remove_shards(dataset_type: str):
+    # Remove the shards of earlier runs, which may have been split into a different number of shards
+    for path in glob.glob(os.path.join(dataset_dir, dataset_type, f'{dataset_type}.tfrecord-*')):
+        os.remove(path)
 
-            for song in songs[start_idx:end_idx]:
-                write_song_to_tfrecord(song, train_writer)
+
+def write_shard_manifest(dataset_type: str, shards: list[dict]):
+    """
+    Write the manifest of a dataset, listing its shards with their number of records and size
+    :param dataset_type: The type of the dataset
+    :param shards: The file name, number of records and size in bytes of every shard
+    """
+    manifest = {
+        'compression': compression,
+        'records': sum(shard['records'] for shard in shards),
+        'shards': shards,
+    }
+    manifest_path = os.path.join(dataset_dir, dataset_type, f'{dataset_type}.manifest.json')
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def create_index_entry(entry_id: str, shard_file_name: str, offset: int, length: int) -> dict:
+    """
+    Create the entry of a record in the record index of a dataset
+    :param entry_id: The id of the example
+    :param shard_file_name: The file name of the shard containing the record
+    :param offset: The position of the record in the shard. For compressed shards, this is the position in the
+    decompressed data.
+    :param length: The length of the serialized example
+    :return: The index entry
+    """
+    return {'id': entry_id, 'shard': shard_file_name, 'offset': offset, 'length': length}
+
+
+def write_record_index(dataset_type: str, entries: list[dict]):
+    """
+    Write the record index of a dataset, which maps the id of every example to the position of its record
+    :param dataset_type: The type of the dataset
+    :param entries: The index entries of all records
+    """
+    index = {entry['id']: {key: entry[key] for key in ('shard', 'offset', 'length')} for entry in entries}
+    index_path = os.path.join(dataset_dir, dataset_type, f'{dataset_type}.index.json')
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file)
+
+
+def split_shards(sizes: list[int], target_bytes: int) -> list[tuple[int, int]]:
+    """
+    Split consecutive songs into shards of about the same size
+    :param sizes: The size of every song in bytes
+    :param target_bytes: The size a shard should have
+    :return: The start and end index of the songs of every shard
+    """
+    if not sizes:
+        return []
+    cumulative_sizes = np.cumsum(sizes)
+    num_shards = max(1, min(len(sizes), round(cumulative_sizes[-1] / target_bytes)))
+    # Every shard ends before or after the song crossing the next multiple of the total size divided by the number of
+    # shards, whichever is closer to it
+    targets = cumulative_sizes[-1] * np.arange(1, num_shards) / num_shards
+    crossing = np.searchsorted(cumulative_sizes, targets)
+    size_before = np.concatenate([[0], cumulative_sizes])[crossing]
+    boundaries = crossing + (cumulative_sizes[crossing] - targets <= targets - size_before)
+    # Boundaries at the first or after the last song would create empty shards
+    boundaries = [0] + sorted(set(boundaries.tolist()) - {0, len(sizes)}) + [len(sizes)]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def get_song_file_path(song_path: str, extension: str) -> str:
+    return os.path.join(song_path, f'{os.path.basename(song_path)}{extension}')
+
+
+def estimate_audio_size_ratio(songs: list[str]) -> float:
+    """
+    Estimate the size of the audio in the configured container relative to the size of the prepared WAVE files
+    :param songs: The directories of the prepared songs
+    :return: The ratio of the transcoded and the WAVE size of evenly spaced sample songs, 1 for WAVE
+    """
+    sample = songs[::max(1, len(songs) // size_sample_songs)][:size_sample_songs]
+    wav_paths = [get_song_file_path(song, '.wav') for song in sample]
+    wav_bytes = sum(map(os.path.getsize, wav_paths))
+    if not wav_bytes:
+        return 1.0
+    return sum(len(transcode_audio(load_binary_file(path))) for path in wav_paths) / wav_bytes
+
+
+def write_shard(song_paths: list[str], shard_path: str) -> list[dict]:
+    """
+    Write the songs of a shard to a TFRecord file
+    :param song_paths: The directories of the prepared songs
+    :param shard_path: The path of the TFRecord file
+    :return: The index entries of the written records
+    """
+    entries = []
+    offset = 0
+    with tf.io.TFRecordWriter(shard_path, options=compression) as writer:
+        for song_path in song_paths:
+            entry_id, length = write_song_to_tfrecord(song_path, writer)
+            entries.append(create_index_entry(entry_id, os.path.basename(shard_path), offset, length))
+            offset += length + RECORD_OVERHEAD
+    return entries
+
+
+def generate_dataset(songs: list[str], dataset_type: Literal['train', 'test']):
+    """
+    Write the songs to shards of about shard_target_bytes each, writing the shards in parallel
+    :param songs: The directories of the prepared songs
+    :param dataset_type: The type of the dataset
+    """
+    os.makedirs(os.path.join(dataset_dir, dataset_type), exist_ok=True)
+    remove_shards(dataset_type)
+
+    # The size of the examples is about the size of the audio in the configured container and the MIDI file, so the
+    # shards can be planned upfront. The compression of FLAC varies between songs, but about averages out per shard.
+    audio_size_ratio = estimate_audio_size_ratio(songs)
+    sizes = [
+        round(os.path.getsize(get_song_file_path(song, '.wav')) * audio_size_ratio)
+        + os.path.getsize(get_song_file_path(song, '.mid'))
+        for song in songs
+    ]
+    shard_ranges = split_shards(sizes, shard_target_bytes)
+    shard_file_names = [get_shard_file_name(dataset_type, shard_index, len(shard_ranges))
+                        for shard_index in range(len(shard_ranges))]
+
+    # Spawn the workers, since forking a process that has imported TensorFlow is not safe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        shard_entries = list(executor.map(
+            write_shard,
+            [songs[start:end] for start, end in shard_ranges],
+            [os.path.join(dataset_dir, dataset_type, file_name) for file_name in shard_file_names],
+        ))
+
+    write_shard_manifest(dataset_type, [
+        {
+            'file': file_name,
+            'records': len(entries),
+            'bytes': os.path.getsize(os.path.join(dataset_dir, dataset_type, file_name)),
+        }
+        for file_name, entries in zip(shard_file_names, shard_entries)
+    ])
+    write_record_index(dataset_type, [entry for entries in shard_entries for entry in entries])
+    print(f'Wrote {sum(map(len, shard_entries))} {dataset_type} songs to {len(shard_ranges)} shards')
 
 
 def generate_datasets():
     os.makedirs(dataset_dir, exist_ok=True)
 
-    songs = [f for f in os.scandir(input_dir) if f.is_dir()]
+    songs = [f.path for f in os.scandir(input_dir) if f.is_dir()]
     train_songs, test_songs = train_test_split(songs, test_size=0.25, random_state=42)
     print(f'Generating datasets with {len(train_songs)} training songs and {len(test_songs)} test songs')
 
@@ -1,36 +1,50 @@
-import tensorflow as tf
-import note_seq
-
-files = ["data/datasets/usdx_vocals.tfrecord"]
-
-# Create dataset of filenames
-dataset = tf.data.Dataset.from_tensor_slices(files)
-
-
-def parse_fn(*args):
-    pb = args[-1]  # Some readers have more than 1 arg.
-    # Parse data using a feature list to convert it into an Example proto
-    return tf.io.parse_single_example(pb, {
-        'sequence': tf.io.FixedLenFeature([], dtype=tf.string),
-        'audio': tf.io.FixedLenFeature([], dtype=tf.string),
-        # 'velocity_range': tf.io.FixedLenFeature([], dtype=tf.string),
-        'id': tf.io.FixedLenFeature([], dtype=tf.string),
-    })
+import os
+import sys
 
-
-def reader(filename):
-    # Load data from file with given name and parse the loaded dataset
-    return tf.data.TFRecordDataset(filename).map(parse_fn)
-
-
-dataset = dataset.interleave(reader, cycle_length=16, block_length=16)
-
-for record in dataset:
-    print("Example record:")
-    print(record['id'])
-    sequence_bytes = record['sequence'].numpy()
-    sequence = note_seq.NoteSequence()
-    sequence.MergeFromString(sequence_bytes)
-    note_seq.note_sequence_to_midi_file(sequence, 'data/out/test.mid')
-    tf.io.write_file('data/out/test.wav', record['audio'])
-    break
+import note_seq
+import soundfile
+
+from usdx_dataset.audio_format import decode_audio
+from usdx_dataset.tfrecord_index import build_record_index, fetch_example, load_record_index, verify_dataset
+
+output_dir = 'data/out/'
+
+usage = '''Usage: python -m usdx_dataset.load_tfrecord <train|test> [<id>|--list|--index|--verify]
+  <id>      Export the MIDI and WAVE file of the example with this id to data/out/
+  --list    Print the ids of all examples
+  --index   Rebuild the record index of the dataset from its shards
+  --verify  Check all records of the dataset'''
+
+
+def export_example(dataset_type: str, entry_id: str):
+    """
+    Export the notes and the audio of a single example
+    :param dataset_type: The type of the dataset
+    :param entry_id: The id of the example
+    """
+    example = fetch_example(dataset_type, entry_id)
+    name = entry_id.split(':')[0][:-4]
+    os.makedirs(output_dir, exist_ok=True)
+    note_seq.note_sequence_to_midi_file(example['sequence'], os.path.join(output_dir, f'{name}.mid'))
+    # The audio may be stored as WAVE or FLAC, so it is decoded and written as WAVE
+    samples, sample_rate = decode_audio(example['audio'])
+    soundfile.write(os.path.join(output_dir, f'{name}.wav'), samples, sample_rate)
+    print(f'Exported {entry_id} ({len(example["sequence"].notes)} notes, {len(samples) / sample_rate:.1f}s) '
+          f'to {output_dir}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ('train', 'test'):
+        print(usage)
+        sys.exit(1)
+    dataset_type = sys.argv[1]
+    command = sys.argv[2] if len(sys.argv) == 3 else '--list'
+    if command == '--list':
+        for entry_id in load_record_index(dataset_type):
+            print(entry_id)
+    elif command == '--index':
+        build_record_index(dataset_type)
+    elif command == '--verify':
+        sys.exit(0 if verify_dataset(dataset_type) else 1)
+    else:
+        export_example(dataset_type, command)
@@ -1,10 +1,16 @@
+import hashlib
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import pydub
-
-from usdx_dataset.usdx_tools import check_validity, usdx_to_midi
+from usdx_dataset.audio_format import encode_audio, load_audio, sample_rate
+from usdx_dataset.usdx_tools import parse_song, song_to_midi
 
 input_dir = 'data/usdx/'
+# Sources and outputs of all prepared songs, used to only prepare added or changed songs on re-runs
+manifest_path = 'data/prepared/manifest.json'
+# Number of worker processes preparing songs in parallel (None uses all cores)
+workers = None
 
 
 def get_files(files: list[str]) -> tuple[None, None] | tuple[str, str]:
@@ -28,9 +34,11 @@ def get_files(files: list[str]) -> tuple[None, None] | tuple[str, str]:
 
 def prepare_audio(mp3_path: str) -> str:
     # Convert the MP3 file to a WAV file since MT3 expects .wav files
+    # The audio is downmixed and resampled to the sample rate MT3 uses, so it doesn't have to be done on every read
     mp3_filename = os.path.basename(mp3_path)[:-4]
     wav_path = f'data/prepared/{mp3_filename}/{mp3_filename}.wav'
-    pydub.AudioSegment.from_mp3(mp3_path).export(wav_path, format='wav')
+    with open(wav_path, 'wb') as wav_file:
+        wav_file.write(encode_audio(*load_audio(mp3_path), container='wav'))
     return wav_path
 
 
@@ -45,40 +53,142 @@ def prepare_midi(usdx_path: str) -> tuple[bool, str]:
     # Convert the usdx .txt file to a MIDI file
     usdx_filename = os.path.basename(usdx_path)[:-4]
     midi_path = f'data/prepared/{usdx_filename}/{usdx_filename}.mid'
-    valid, reason = check_validity(usdx_path)
-    if not valid:
+    # Check the validity and read the notes in a single pass over the file
+    song = parse_song(usdx_path)
+    if not song.valid:
         # Skip songs that are not suitable for training
-        return False, reason
-    usdx_to_midi(usdx_path, midi_path)
+        return False, song.reason
+    song_to_midi(song, midi_path)
     return True, midi_path
 
 
+def get_file_state(path: str, previous: dict = None) -> dict:
+    """
+    Get the state of a source file for the manifest
+    :param path: The path of the file
+    :param previous: The state of the file stored in the manifest. If size and modification time didn't change, its
+    hash is reused instead of reading the whole file again.
+    :return: The size, modification time and content hash of the file
+    """
+    stat = os.stat(path)
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+def prepare_song(root: str, mp3_file: str, usdx_file: str) -> dict:
+    """
+    Prepare the MIDI and WAV file of a single song
+    :param root: The directory of the song
+    :param mp3_file: The name of the MP3 file
+    :param usdx_file: The name of the USDX .txt file
+    :return: The manifest entry of the song, containing its status, the rejection reason and the output files
+    """
+    usdx_path = os.path.join(root, usdx_file)
+    success, other = prepare_midi(usdx_path)
+    if not success:
+        # Song is not suitable for training, skip it
+        print(f'Song {root} is not suitable for training ({other}), skipping')
+        return {'status': 'rejected', 'reason': other, 'outputs': []}
+
+    mp3_path = os.path.join(root, mp3_file)
+    wav_path = prepare_audio(mp3_path)
+    print(f'Prepared {root}')
+    return {'status': 'prepared', 'reason': '', 'outputs': [other, wav_path], 'sample_rate': sample_rate}
+
+
+def load_manifest() -> dict:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    # Write to a temporary file first, so an interrupted run never leaves a damaged manifest behind
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def remove_outputs(entry: dict):
+    for output in entry['outputs']:
+        if os.path.exists(output):
+            os.remove(output)
+
+
 def prepare_data(input_dir: str):
-    song_rejection_reasons = {}
+    manifest = load_manifest()
+    songs = {}
     # Walk through all the subdirectories in the input_dir
     for root, _, files in os.walk(input_dir, onerror=print):
         # Skip top directory
         if root == input_dir:
             continue
-        print(f'Preparing {root}...')
         mp3_file, usdx_file = get_files(files)
         if mp3_file is None:
             print(f'MP3/USDX file missing in {root}, skipping')
             continue
-
-        # Directory contains necessary files, prepare them for the dataset
-        usdx_path = os.path.join(root, usdx_file)
-        success, other = prepare_midi(usdx_path)
-        if not success:
-            # Song is not suitable for training, skip it
-            print(f'Song {root} is not suitable for training ({other}), skipping')
-            song_rejection_reasons[other] = song_rejection_reasons.get(other, 0) + 1
+        songs[root] = (mp3_file, usdx_file)
+
+    # Remove songs whose sources don't exist anymore
+    for root in set(manifest) - set(songs):
+        print(f'Removing {root}, since its sources were deleted')
+        remove_outputs(manifest.pop(root))
+
+    # Only prepare songs that were added or whose sources changed since they were prepared
+    pending = {}
+    for root, (mp3_file, usdx_file) in songs.items():
+        entry = manifest.get(root)
+        previous_sources = entry['sources'] if entry is not None else {}
+        sources = {
+            file: get_file_state(os.path.join(root, file), previous_sources.get(file))
+            for file in (mp3_file, usdx_file)
+        }
+        # Only the content counts, files that were just touched or copied keep their outputs
+        unchanged = sources.keys() == previous_sources.keys() and all(
+            state['sha256'] == previous_sources[file]['sha256'] for file, state in sources.items())
+        # Songs prepared with another sample rate have to be prepared again, rejected songs stay rejected
+        up_to_date = entry is not None and entry['status'] != 'failed' and unchanged and (
+                entry['status'] == 'rejected' or entry.get('sample_rate') == sample_rate)
+        if up_to_date:
+            # Store the new modification times, so the files don't have to be hashed again on the next run
+            entry['sources'] = sources
             continue
-
-        mp3_path = os.path.join(root, mp3_file)
-        prepare_audio(mp3_path)
-        print(f'Prepared {root}')
-
+        if entry is not None:
+            remove_outputs(entry)
+            manifest.pop(root)
+        pending[root] = sources
+    print(f'Preparing {len(pending)} of {len(songs)} songs, {len(songs) - len(pending)} are up to date')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(prepare_song, root, *songs[root]): root for root in pending}
+        for completed, future in enumerate(as_completed(futures), start=1):
+            root = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f'Preparing {root} failed: {e}')
+                entry = {'status': 'failed', 'reason': str(e), 'outputs': []}
+            entry['sources'] = pending[root]
+            manifest[root] = entry
+            # Save progress regularly, so an interrupted run doesn't have to start over
+            if completed % 50 == 0:
+                save_manifest(manifest)
+    save_manifest(manifest)
+
+    # Aggregate the rejections of all songs, including the ones prepared by earlier runs
+    song_rejection_reasons = {}
+    for entry in manifest.values():
+        if entry['status'] != 'prepared':
+            reason = entry['reason'] if entry['status'] == 'rejected' else 'FAILED'
+            song_rejection_reasons[reason] = song_rejection_reasons.get(reason, 0) + 1
     print('Skipped songs:')
     for reason, count in song_rejection_reasons.items():
         print(f'{reason}: {count}')
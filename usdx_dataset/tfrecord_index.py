@@ -0,0 +1,291 @@
+import gzip
+import json
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import note_seq
+import tensorflow as tf
+
+from usdx_dataset.audio_format import decode_audio
+from usdx_dataset.create_usdx_dataset import (
+    RECORD_OVERHEAD, create_index_entry, dataset_dir, write_record_index
+)
+
+try:
+    # Native CRC32C implementation, which is much faster than the pure Python implementation below
+    from google_crc32c import value as native_crc32c
+except ImportError:
+    native_crc32c = None
+# The pure Python implementation is too slow for the data of whole shards, so without the native implementation only
+# the CRCs of the record lengths are checked
+check_data_crc = native_crc32c is not None
+
+# Number of worker processes verifying shards in parallel (None uses all cores)
+workers = None
+
+RECORD_HEADER = struct.Struct('<QI')
+RECORD_FOOTER = struct.Struct('<I')
+
+
+def _create_crc32c_table() -> list[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = _create_crc32c_table()
+
+
+def crc32c(data: bytes) -> int:
+    if native_crc32c is not None:
+        return native_crc32c(data)
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data: bytes) -> int:
+    # TFRecords store the CRCs masked, see tensorflow/core/lib/hash/crc32c.h
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+class ZlibFile:
+    """
+    Minimal file object reading the decompressed data of a ZLIB compressed file, since the zlib module only provides
+    decompression of in-memory data. Only reading and seeking forward are supported.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self._file = open(path, 'rb')
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._position = 0
+        self._chunk_size = chunk_size
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size and not self._decompressor.eof:
+            chunk = self._file.read(self._chunk_size)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int):
+        if offset < self._position:
+            raise ValueError('ZlibFile can only seek forward')
+        while self._position < offset:
+            if not self.read(min(offset - self._position, self._chunk_size)):
+                break
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_shard(path: str, compression: str | None):
+    """
+    Open a shard for reading its records
+    :param path: The path of the shard
+    :param compression: The compression of the shard, None, 'GZIP' or 'ZLIB'
+    :return: A file object reading the decompressed data of the shard
+    """
+    if compression is None:
+        return open(path, 'rb')
+    if compression == 'GZIP':
+        return gzip.open(path, 'rb')
+    if compression == 'ZLIB':
+        return ZlibFile(path)
+    raise ValueError(f'Unknown compression: {compression}')
+
+
+def read_record(file, check_crc: bool = True) -> tuple[bytes, bool] | None:
+    """
+    Read the next record of a TFRecord file
+    :param file: The file object positioned at the start of a record
+    :param check_crc: Whether the CRCs of the record should be checked. The CRC of the data is only checked if
+    check_data_crc is set.
+    :return: The data of the record and whether its CRC matches, or None at the end of the file
+    :raises ValueError: If the record is truncated or its length is corrupted, so the following records can't be found
+    """
+    header = file.read(RECORD_HEADER.size)
+    if not header:
+        return None
+    if len(header) < RECORD_HEADER.size:
+        raise ValueError('Truncated record header')
+    length, length_crc = RECORD_HEADER.unpack(header)
+    if check_crc and masked_crc32c(header[:8]) != length_crc:
+        raise ValueError('Corrupted record length')
+    data = file.read(length)
+    footer = file.read(RECORD_FOOTER.size)
+    if len(data) < length or len(footer) < RECORD_FOOTER.size:
+        raise ValueError('Truncated record')
+    data_valid = not (check_crc and check_data_crc) or masked_crc32c(data) == RECORD_FOOTER.unpack(footer)[0]
+    return data, data_valid
+
+
+def parse_example(data: bytes) -> dict:
+    """
+    Parse a serialized example of the dataset
+    :param data: The serialized example
+    :return: The id, the encoded audio and the NoteSequence of the example
+    """
+    features = tf.train.Example.FromString(data).features.feature
+    return {
+        'id': features['id'].bytes_list.value[0].decode('utf-8'),
+        'audio': features['audio'].bytes_list.value[0],
+        'sequence': note_seq.NoteSequence.FromString(features['sequence'].bytes_list.value[0]),
+    }
+
+
+def load_manifest(dataset_type: str) -> dict:
+    with open(os.path.join(dataset_dir, dataset_type, f'{dataset_type}.manifest.json')) as manifest_file:
+        return json.load(manifest_file)
+
+
+def load_record_index(dataset_type: str) -> dict:
+    with open(os.path.join(dataset_dir, dataset_type, f'{dataset_type}.index.json')) as index_file:
+        return json.load(index_file)
+
+
+def fetch_example(dataset_type: str, entry_id: str, index: dict = None, compression: str = None) -> dict:
+    """
+    Read a single example by its id, seeking directly to its record instead of reading the shards
+    :param dataset_type: The type of the dataset
+    :param entry_id: The id of the example
+    :param index: The record index of the dataset. Loaded from the dataset if None.
+    :param compression: The compression of the shards. Read from the manifest of the dataset if no index is given.
+    :return: The parsed example
+    :raises KeyError: If the dataset doesn't contain an example with this id
+    """
+    if index is None:
+        index = load_record_index(dataset_type)
+        compression = load_manifest(dataset_type)['compression']
+    entry = index[entry_id]
+    with open_shard(os.path.join(dataset_dir, dataset_type, entry['shard']), compression) as shard_file:
+        shard_file.seek(entry['offset'])
+        record = read_record(shard_file)
+    if record is None or len(record[0]) != entry['length']:
+        raise ValueError(f'The record index of {dataset_type} is out of date, rebuild it')
+    data, data_valid = record
+    if not data_valid:
+        raise ValueError(f'Record {entry_id} is corrupted')
+    return parse_example(data)
+
+
+def index_shard(shard_path: str, compression: str | None) -> list[dict]:
+    """
+    Find the position of all records of a shard
+    :param shard_path: The path of the shard
+    :param compression: The compression of the shard
+    :return: The index entries of the records
+    """
+    entries = []
+    offset = 0
+    with open_shard(shard_path, compression) as shard_file:
+        while (record := read_record(shard_file, check_crc=False)) is not None:
+            data = record[0]
+            entry_id = tf.train.Example.FromString(data).features.feature['id'].bytes_list.value[0].decode('utf-8')
+            entries.append(create_index_entry(entry_id, os.path.basename(shard_path), offset, len(data)))
+            offset += len(data) + RECORD_OVERHEAD
+    return entries
+
+
+def build_record_index(dataset_type: str):
+    """
+    Build the record index of an existing dataset, e.g. one written before the datasets contained an index
+    :param dataset_type: The type of the dataset
+    """
+    manifest = load_manifest(dataset_type)
+    shard_paths = [os.path.join(dataset_dir, dataset_type, shard['file']) for shard in manifest['shards']]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        shard_entries = executor.map(index_shard, shard_paths, [manifest['compression']] * len(shard_paths))
+        entries = [entry for entries in shard_entries for entry in entries]
+    write_record_index(dataset_type, entries)
+    print(f'Indexed {len(entries)} records in {len(shard_paths)} shards of {dataset_type}')
+
+
+def verify_shard(shard_path: str, compression: str | None) -> dict:
+    """
+    Check that all records of a shard are intact: their CRCs match, the NoteSequence can be parsed and the audio can
+    be decoded
+    :param shard_path: The path of the shard
+    :param compression: The compression of the shard
+    :return: The number of records, the decompressed size, the errors and the duration of the verification
+    """
+    start_time = time.time()
+    records = 0
+    size = 0
+    errors = []
+    offset = 0
+    with open_shard(shard_path, compression) as shard_file:
+        while True:
+            try:
+                record = read_record(shard_file)
+            except ValueError as e:
+                # The following records can't be found without a valid length
+                errors.append(f'{os.path.basename(shard_path)}@{offset}: {e}')
+                break
+            if record is None:
+                break
+            data, data_valid = record
+            location = f'{os.path.basename(shard_path)}@{offset}'
+            records += 1
+            size += len(data) + RECORD_OVERHEAD
+            offset += len(data) + RECORD_OVERHEAD
+            if not data_valid:
+                errors.append(f'{location}: CRC mismatch')
+                continue
+            try:
+                example = parse_example(data)
+                decode_audio(example['audio'])
+            except Exception as e:
+                errors.append(f'{location}: {e}')
+    return {'records': records, 'bytes': size, 'errors': errors, 'seconds': time.time() - start_time}
+
+
+def verify_dataset(dataset_type: str) -> bool:
+    """
+    Verify all shards of a dataset in parallel and print the throughput
+    :param dataset_type: The type of the dataset
+    :return: True if all records are intact, otherwise False
+    """
+    manifest = load_manifest(dataset_type)
+    shard_paths = [os.path.join(dataset_dir, dataset_type, shard['file']) for shard in manifest['shards']]
+    if not check_data_crc:
+        print('Warning: google-crc32c is not installed, the CRCs of the record data are not checked')
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        results = list(executor.map(verify_shard, shard_paths, [manifest['compression']] * len(shard_paths)))
+    seconds = time.time() - start_time
+
+    records = sum(result['records'] for result in results)
+    size = sum(result['bytes'] for result in results)
+    errors = [error for result in results for error in result['errors']]
+    for error in errors:
+        print(error)
+    if records != manifest['records']:
+        errors.append(f'Expected {manifest["records"]} records, found {records}')
+        print(errors[-1])
+    print(f'Verified {records} records ({size / 1024 ** 2:.1f} MiB) in {len(shard_paths)} shards of {dataset_type} '
+          f'in {seconds:.1f}s: {records / seconds:.1f} records/s, {size / 1024 ** 2 / seconds:.1f} MiB/s, '
+          f'{len(errors)} errors')
+    return not errors
@@ -1,9 +1,44 @@
 import codecs
 import os
 
+import numpy as np
 from mido import Message, MetaMessage, MidiFile, MidiTrack, bpm2tempo, second2tick
 import chardet
 
+# Number of bytes chardet looks at if a file is not UTF-8
+ENCODING_SNIFF_SIZE = 16 * 1024
+
+
+def detect_encoding(data: bytes) -> str:
+    """
+    Detect the encoding of a song file.
+    Files with a BOM or valid UTF-8 (which includes ASCII) are detected without chardet. For all other files, chardet
+    first only looks at the beginning of the file. If that part is plain ASCII or the detected encoding can't decode
+    the whole file, chardet looks at the whole file, and latin-1, which decodes any data, is used as last resort.
+    :param data: The content of the file
+    :return: The encoding of the file
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    for sample in (data[:ENCODING_SNIFF_SIZE], data):
+        encoding = chardet.detect(sample)['encoding']
+        # A plain ASCII beginning says nothing about the special characters later in the file
+        if encoding is None or encoding.lower() == 'ascii':
+            continue
+        try:
+            data.decode(encoding)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return 'latin-1'
+
 
 def get_file_encoding(filepath: str) -> str:
     """
@@ -12,7 +47,77 @@ def get_file_encoding(filepath: str) -> str:
     :return: The encoding of the file
     """
     with open(filepath, 'rb') as f:
-        return chardet.detect(f.read())['encoding']
+        return detect_encoding(f.read())
+
+
+class SongData:
+    """
+    The relevant data of a USDX song file.
+    The notes are stored as arrays of their start beats, lengths in beats and normalized pitches.
+    """
+    __slots__ = ('valid', 'reason', 'header', 'bpm', 'start_offset', 'starts', 'lengths', 'pitches')
+
+    def __init__(self, valid: bool, reason: str, header: dict, bpm: float, start_offset: int | None,
+                 starts: np.ndarray, lengths: np.ndarray, pitches: np.ndarray):
+        self.valid = valid
+        self.reason = reason
+        self.header = header
+        self.bpm = bpm
+        self.start_offset = start_offset
+        self.starts = starts
+        self.lengths = lengths
+        self.pitches = pitches
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def parse_song(filepath: str, parse_notes: bool = True) -> SongData:
+    """
+    Read a USDX song file once, checking its validity and extracting the header and the notes at the same time
+    :param filepath: The path of the USDX song file
+    :param parse_notes: Whether the notes should be extracted. If False, only the header and the validity are read.
+    :return: The song data
+    """
+    with open(filepath, 'rb') as song_file:
+        data = song_file.read()
+    text = data.decode(detect_encoding(data))
+
+    valid, reason = True, ''
+    header = {}
+    starts = []
+    lengths = []
+    pitches = []
+    for line in text.splitlines():
+        if not line:
+            continue
+        first = line[0]
+        if first == ':' or first == '*':
+            if parse_notes:
+                parts = line.split()
+                starts.append(int(parts[1]))
+                lengths.append(int(parts[2]))
+                pitches.append(int(parts[3]))
+        elif first == '#':
+            key, _, value = line[1:].partition(':')
+            header[key] = value.strip()
+            if valid and line.startswith('#RELATIVE:YES'):
+                valid, reason = False, 'RELATIVE'
+        elif valid and (first == 'f' or first == 'F'):
+            valid, reason = False, 'RAP_NOTES'
+        elif valid and (line.startswith('P1') or line.startswith('p1')):
+            valid, reason = False, 'DUET'
+
+    bpm = to_float(header['BPM']) if 'BPM' in header else 0
+    start_offset = None
+    if 'GAP' in header:
+        start_offset = int(second2tick(to_float(header['GAP']) / 1000.0, 4, bpm2tempo(bpm)))
+    return SongData(
+        valid, reason, header, bpm, start_offset,
+        np.array(starts, dtype=np.int64),
+        np.array(lengths, dtype=np.int64),
+        normalize_pitches(np.array(pitches, dtype=np.int64)),
+    )
 
 
 def check_validity(filepath: str) -> tuple[bool, str]:
@@ -21,18 +126,12 @@ def check_validity(filepath: str) -> tuple[bool, str]:
     The following songs are currently not suitable:
     - Songs with rap notes
     - Duet songs
+    - Songs using relative timing
     :param filepath: The path of the USDX song file
     :return: True if the song is suitable for model training, otherwise false
     """
-    with (codecs.open(filepath, 'r', encoding=get_file_encoding(filepath)) as song_file):
-        for line in song_file:
-            if line.startswith('f') or line.startswith('F'):
-                return False, 'RAP_NOTES'
-            if line.startswith('P1') or line.startswith('p1'):
-                return False, 'DUET'
-            if line.startswith('#RELATIVE:YES'):
-                return False, 'RELATIVE'
-        return True, ''
+    song = parse_song(filepath, parse_notes=False)
+    return song.valid, song.reason
 
 
 def to_float(value: str) -> float:
@@ -56,42 +155,38 @@ def normalize_notes(notes: list):
     return notes
 
 
+def normalize_pitches(pitches: np.ndarray) -> np.ndarray:
+    """
+    Same as normalize_notes, but for an array of pitches
+    :param pitches: The pitches of all notes
+    :return: The normalized pitches
+    """
+    if len(pitches) == 0:
+        return pitches
+    lowest_pitch = int(pitches.min())
+    # Calculate the lowest possible offset
+    offset_factor = int(lowest_pitch / 12.0)
+    if lowest_pitch < 0:
+        # If there are notes with negative pitch, move notes up one more octave so that all pitches are positive
+        offset_factor -= 1
+    return pitches - offset_factor * 12
+
+
 def load_song_data(filepath: str) -> dict:
     """
     Load the relevant data of a USDX song file
     :param filepath: The path of the USDX song file
     :return: The data of the song
     """
+    song = parse_song(filepath)
     data = {
-        'bpm': 0,
+        'bpm': song.bpm,
         'gap': 0,
-        'notes': []
+        'notes': [{'start': start, 'length': length, 'pitch': pitch} for start, length, pitch
+                  in zip(song.starts.tolist(), song.lengths.tolist(), song.pitches.tolist())]
     }
-
-    with codecs.open(filepath, 'r', encoding=get_file_encoding(filepath)) as song_file:
-        for line in song_file:
-            if line.startswith('#BPM:'):
-                data['bpm'] = to_float(line.split(':')[1])
-
-            if line.startswith('#GAP:'):
-                gap = to_float(line.split(':')[1])
-                data['start_offset'] = int(second2tick(gap / 1000.0, 4, bpm2tempo(data['bpm'])))
-
-            if not line.startswith(':') and not line.startswith('*'):
-                continue
-
-            parts = line.split()
-            start = int(parts[1])
-            length = int(parts[2])
-            pitch = int(parts[3])
-
-            data['notes'].append({
-                'start': start,
-                'length': length,
-                'pitch': pitch
-            })
-
-    normalize_notes(data['notes'])
+    if song.start_offset is not None:
+        data['start_offset'] = song.start_offset
     return data
 
 
@@ -101,24 +196,29 @@ def usdx_to_midi(in_filepath: str, out_filepath: str):
     :param in_filepath: The path of the USDX song file
     :param out_filepath: The output path of the generated MIDI file
     """
-    data = load_song_data(in_filepath)
+    song_to_midi(parse_song(in_filepath), out_filepath)
 
+
+def song_to_midi(song: SongData, out_filepath: str):
+    """
+    Convert parsed USDX song data to a MIDI file
+    :param song: The song data
+    :param out_filepath: The output path of the generated MIDI file
+    """
     # Create MIDI file and set initial values
     mid = MidiFile()
     track = MidiTrack()
     mid.tracks.append(track)
     mid.ticks_per_beat = 4
     track.append(Message('program_change', program=1, time=0))
-    track.append(MetaMessage('set_tempo', tempo=bpm2tempo(data['bpm']), time=0))
+    track.append(MetaMessage('set_tempo', tempo=bpm2tempo(song.bpm), time=0))
 
     current_position = 0
     first_note = True
-    start_offset = data['start_offset']
+    start_offset = song.start_offset
 
-    for note in data['notes']:
-        start = note['start']
-        length = note['length']
-        note = 60 + note['pitch']
+    for start, length, pitch in zip(song.starts.tolist(), song.lengths.tolist(), song.pitches.tolist()):
+        note = 60 + pitch
 
         # Calculate the onset time of the note
         # The onset time is the delta time since the last note event